@@ -1,31 +1,137 @@
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+from enum import Enum
 import time
 import json
+import re
 from logging import Logger
 import uuid
 from pytradfri import Gateway
+from pytradfri.api.aiocoap_api import APIFactory as AsyncAPIFactory
 from pytradfri.api.libcoap_api import APIFactory
+from pytradfri.device import Device
 from pytradfri.group import Group
 from pytradfri.command import Command
+from pytradfri.const import ATTR_DEVICE_STATE, ATTR_LIGHT_COLOR_HEX, ATTR_LIGHT_DIMMER, ATTR_TRANSITION_TIME
 from pytradfri.error import RequestTimeout
-from typing import Callable, Iterable, Tuple, Union
+from aiocoap.error import NotObservable, ObservationCancelled
+from threading import Lock, Thread
+from typing import Callable, Iterable, Optional, Tuple, Union
 
 import numpy
 
 CONFIG_FILE = "tradfri_psk.conf"
+# Maximum number of simultaneous requests to the gateway when loading groups
+MAX_CONCURRENT_REQUESTS = 4
+# Groups older than this are reloaded in the background when read
+MAX_GROUPS_AGE_SECONDS = 5 * 60
+# How often the background refresher reloads all groups from the gateway, only
+# as often as they would otherwise be too old to serve
+REFRESH_INTERVAL_SECONDS = MAX_GROUPS_AGE_SECONDS
+# Initial and maximum delay before observing a group or light again after its
+# observation ended, the delay doubles while observations keep ending quickly
+OBSERVE_RETRY_SECONDS = 5
+OBSERVE_MAX_RETRY_SECONDS = 5 * 60
+# Limits for resending a command until the group and its lights agree on the value
+RECONCILE_MAX_ATTEMPTS = 8
+RECONCILE_INITIAL_DELAY_SECONDS = 0.1
+RECONCILE_DEADLINE_SECONDS = 5
 
-class RGB(numpy.ndarray):
-  @classmethod
-  def from_str(cls, hex: str):
-    return numpy.array([int(hex[i:i+2], 16) for i in (0, 2, 4)]).view(cls)
+class CommandResult(Enum):
+    OK = "ok"
+    NOT_FOUND = "not-found"
+    # The gateway did not respond to the command
+    FAILED = "failed"
+    # The command was sent, but the group and its lights never agreed on the value
+    NOT_CONVERGED = "not-converged"
 
-  def __str__(self):
-    self = self.astype(numpy.uint8)
-    return ''.join(format(n, 'x') for n in self)
+class CommandStats:
+    LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, float("inf"))
+
+    def __init__(self):
+        self.attempts = Counter()
+        self.latencies = Counter()
+        self.results = Counter()
+
+    def record(self, attempts: int, latency: float, result: CommandResult):
+        self.attempts[attempts] += 1
+        self.latencies[next(bucket for bucket in self.LATENCY_BUCKETS if latency <= bucket)] += 1
+        self.results[result.value] += 1
+
+    def export(self) -> dict:
+        return {
+            "attempts": dict(sorted(self.attempts.items())),
+            "latencies": {str(bucket): self.latencies[bucket] for bucket in self.LATENCY_BUCKETS},
+            "results": dict(self.results)
+        }
+
+# Thanks IKEA! Setting the dimmer to the value the group already believes it has
+# does not reach the lights, so send one less first and then the value again.
+class DimmerTarget:
+    def __init__(self, value: int):
+        self.value = value
+        self.try_value = value
+
+    def is_converged(self, get_val: int, g_get_val: int) -> bool:
+        if get_val == g_get_val:
+            if self.try_value == self.value:
+                return True
+            self.try_value = self.value
+            return False
+
+        if self.try_value == g_get_val:
+            if self.try_value == self.value:
+                self.try_value -= 1
+            else:
+                self.try_value = self.value
+        return False
+
+# Raises a ValueError unless the values can be passed to set_group_values
+def check_group_values(values: dict):
+    if not isinstance(values, dict):
+        raise ValueError("Expected an object of values.")
+    for key, value in values.items():
+        if key == "light-state":
+            valid = isinstance(value, bool)
+        elif key == "dimmer":
+            valid = isinstance(value, int) and not isinstance(value, bool) and 0 <= value <= 254
+        elif key == "color":
+            valid = isinstance(value, str) and re.fullmatch("#?[0-9a-fA-F]{6}", value) is not None
+        else:
+            raise ValueError("Unknown value: {}".format(key))
+        if not valid:
+            raise ValueError("Invalid {}: {}".format(key, value))
 
 class TradfriHandler:
-    def __init__(self, gateway_hostname: str, key: str, logger: Logger):
+    def __init__(self, gateway_hostname: str, key: str, logger: Logger,
+                 max_concurrent_requests: int = MAX_CONCURRENT_REQUESTS, api: Callable = None):
         self.logger = logger
+        self.max_concurrent_requests = max_concurrent_requests
+        self.refresh_timings: dict[str, float] = {}
+        self.groups: dict[int, Group] = {}
+        self.group_members: dict[int, Iterable] = {}
+        self.group_loaded_at: dict[int, float] = {}
+        self.groups_last_updated = None
+        self.refresh_lock = Lock()
+        self.observer = None
+        # The host, identity and key of the gateway, for the observer's own session
+        self.credentials: Optional[Tuple[str, str, str]] = None
+        # The exported groups without their age, rebuilt after a group or light changed
+        self.export_lock = Lock()
+        self.export_snapshot: Optional[dict[int, dict]] = None
+        self.export_version = 0
+        self.command_stats: dict[str, CommandStats] = {"state": CommandStats(), "dimmer": CommandStats(),
+                                                     "batch": CommandStats()}
+        self.gateway = Gateway()
+        if api is not None:
+            self.api = api
+        else:
+            self.api = self.create_api(gateway_hostname, key)
+        self.load_groups()
+
+    def create_api(self, gateway_hostname: str, key: str) -> Callable:
         conf = self.load_psk(CONFIG_FILE)
 
         try:
@@ -40,9 +146,8 @@ class TradfriHandler:
 
         conf[gateway_hostname] = {"identity": identity, "key": psk}
         self.save_psk(CONFIG_FILE, conf)
-        self.api = api_factory.request
-        self.gateway = Gateway()
-        self.load_groups()
+        self.credentials = (gateway_hostname, identity, psk)
+        return api_factory.request
 
     @staticmethod
     def load_psk(filename: str) -> dict:
@@ -58,13 +163,23 @@ class TradfriHandler:
         with open(filename, "w", encoding="utf-8") as fdesc:
             fdesc.write(data)
 
+    # Averages the colors from start to end of every (start, end) range in one pass.
+    # The result is None for empty ranges.
     @staticmethod
-    def average_hex_color(colors: list[str]):
-        if len(colors) == 1:
-            return colors[0]
-        rgb_colors = [RGB.from_str(hex) for hex in colors]
-        return (numpy.sum(rgb_colors, axis=0) // len(rgb_colors)).view(RGB)
-    
+    def average_hex_colors(colors: list[str], ranges: list[Tuple[int, int]]) -> list[Optional[str]]:
+        if not ranges:
+            return []
+        rgb = numpy.frombuffer(bytes.fromhex(''.join(colors)), dtype=numpy.uint8).reshape(-1, 3)
+        # The sum of a range is the difference between the cumulative sums at its ends
+        sums = numpy.zeros((len(colors) + 1, 3), dtype=numpy.int64)
+        numpy.cumsum(rgb, axis=0, out=sums[1:])
+        starts, ends = numpy.array(ranges).T
+        counts = ends - starts
+        averages = (sums[ends] - sums[starts]) // numpy.maximum(counts, 1)[:, None]
+        hex_colors = averages.astype(numpy.uint8).tobytes().hex()
+        return ['#' + hex_colors[index * 6:index * 6 + 6] if count else None
+                for index, count in enumerate(counts)]
+
     @staticmethod
     def get_hex_color_dimmer_state_light_control(group_members) -> Tuple[Iterable, Iterable, Iterable]:
         # These properties exists on the group as well, but they are incorrect for some reason
@@ -75,36 +190,94 @@ class TradfriHandler:
                                 group_members)
                         ))
 
-    def export_group(self, group: Group) -> dict[str, Union[str, int]]:
-        hex_colors, states, dimmers = self.get_hex_color_dimmer_state_light_control(self.group_members[group.id])
-        return {
-            "name": group.name,
-            "id": group.id,
-            "state": any(states),
-            "dimmer": dimmers[0],
-            "color": '#' + str(self.average_hex_color(list(hex_colors)))
-        }
+    def build_export_snapshot(self) -> dict[int, dict]:
+        snapshot = {}
+        colors = []
+        ranges = []
+        for group in list(self.groups.values()):
+            # Like get_hex_color_dimmer_state_light_control, use the lights rather than the group
+            lights = [member.light_control.lights[0] for member in self.group_members.get(group.id, [])
+                      if member.has_light_control]
+            start = len(colors)
+            colors += [light.hex_color for light in lights if light.hex_color]
+            ranges.append((start, len(colors)))
+            snapshot[group.id] = {
+                "name": group.name,
+                "id": group.id,
+                "state": any(light.state for light in lights),
+                "dimmer": lights[0].dimmer if lights else None
+            }
+
+        for exported, color in zip(snapshot.values(), self.average_hex_colors(colors, ranges)):
+            exported["color"] = color
+        return snapshot
+
+    def get_export_snapshot(self) -> dict[int, dict]:
+        snapshot = self.export_snapshot
+        if snapshot is None:
+            version = self.export_version
+            snapshot = self.build_export_snapshot()
+            with self.export_lock:
+                # Only keep it if nothing changed while it was built
+                if self.export_version == version:
+                    self.export_snapshot = snapshot
+        return snapshot
+
+    def invalidate_export(self):
+        with self.export_lock:
+            self.export_version += 1
+            self.export_snapshot = None
 
     def export_groups(self) -> list[str]:
-        return list(map(self.export_group, self.get_groups()))
+        groups = list(self.get_groups())
+        snapshot = self.get_export_snapshot()
+        return [dict(snapshot[group.id], age=self.get_age(group.id)) for group in groups if group.id in snapshot]
 
-    def load_group_members(self, group: Group):
+    def load_group_members(self, group: Group) -> bool:
         try:
             self.group_members[group.id] = self.api(group.members())
+            return True
         except RequestTimeout:
             self.logger.error("Trådfri timed out!")
+            return False
 
     def load_groups(self):
-        self.groups: dict[int, Group] = {}
-        self.group_members: dict[int, Iterable] = {}
+        start = time.monotonic()
+        groups: dict[int, Group] = {}
+        group_members: dict[int, Iterable] = {}
         try:
             devices_commands = self.api(self.gateway.get_groups())
-            groups = self.api(devices_commands)
-            for group in groups:
-                self.groups[group.id] = group
-                self.load_group_members(group)
+            with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+                for group in executor.map(self.api, devices_commands):
+                    groups[group.id] = group
+                groups_loaded = time.monotonic()
+
+                # Fetch the members of all groups at once instead of group by group
+                member_commands = [(group.id, group.members()) for group in groups.values()]
+                member_futures = [(group_id, [executor.submit(self.api, command) for command in commands])
+                                  for group_id, commands in member_commands]
+                for group_id, futures in member_futures:
+                    try:
+                        group_members[group_id] = [future.result() for future in futures]
+                    except RequestTimeout:
+                        self.logger.error("Trådfri timed out!")
+            end = time.monotonic()
+            self.groups = groups
+            self.group_members = group_members
+            self.group_loaded_at = dict.fromkeys(group_members, end)
+            self.invalidate_export()
             self.groups_last_updated = datetime.now()
+            if self.observer:
+                self.observer.sync()
+
+            self.refresh_timings = {
+                "groups": groups_loaded - start,
+                "members": end - groups_loaded,
+                "total": end - start,
+            }
+            self.logger.info("Loaded {} Trådfri groups in {:.2f} s".format(len(groups), end - start))
         except RequestTimeout:
+            # Keep serving the previously loaded groups
             self.logger.error("Trådfri timed out!")
             self.groups_last_updated = None
 
@@ -112,28 +285,83 @@ class TradfriHandler:
         try:
             group = self.api(self.gateway.get_group(group_id))
             self.groups[group.id] = group
-            self.load_group_members(group)
+            if self.load_group_members(group):
+                self.group_loaded_at[group.id] = time.monotonic()
+            self.invalidate_export()
         except RequestTimeout:
             self.logger.error("Trådfri timed out!")
 
-    def get_state(self, group_id: int, refresh_data=True) -> bool:
-        current_value, _ = self.get_state_internal(group_id, refresh_data)
-        return current_value
+    def start_refresher(self, interval: float = REFRESH_INTERVAL_SECONDS):
+        def run():
+            while True:
+                time.sleep(interval)
+                # No need to poll the gateway when it tells us about every change
+                if self.observer and all(map(self.observer.is_observing, list(self.groups))):
+                    continue
+                self.refresh_groups()
+
+        Thread(target=run, daemon=True).start()
 
-    def get_state_internal(self, group_id: int, refresh_data=True) -> Union[bool, bool]:
-        if refresh_data:
+    # The api is an async request function such as that of pytradfri's aiocoap
+    # APIFactory. Without one, the observer opens a session of its own.
+    def start_observing(self, api: Callable = None):
+        if api is None and self.credentials is None:
+            return
+        self.observer = TradfriObserver(self, self.logger, api=api, credentials=self.credentials)
+        self.observer.sync()
+
+    # Called by the observer when the gateway reports a change
+    def apply_group(self, group: Group):
+        if group.id in self.groups:
+            self.groups[group.id] = group
+            self.invalidate_export()
+
+    def apply_device(self, device: Device):
+        for members in self.group_members.values():
+            for index, member in enumerate(members):
+                if member.id == device.id:
+                    members[index] = device
+        self.invalidate_export()
+
+    def refresh_groups(self):
+        # Skip if another thread is already refreshing
+        if not self.refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.load_groups()
+        finally:
+            self.refresh_lock.release()
+
+    # Seconds since the group was last fetched from the gateway
+    def get_age(self, group_id: int) -> float:
+        # Observed groups are always up to date
+        if self.observer and self.observer.is_observing(group_id):
+            return 0
+        if group_id not in self.group_loaded_at:
+            return float("inf")
+        return time.monotonic() - self.group_loaded_at[group_id]
+
+    # None means that any cached value is fine, 0 always refetches the group
+    def ensure_max_age(self, group_id: int, max_age: Optional[float]):
+        if max_age is not None and self.get_age(group_id) > max_age:
             self.load_group(group_id)
+
+    def get_state(self, group_id: int, max_age: Optional[float] = 0) -> bool:
+        current_value, _ = self.get_state_internal(group_id, max_age)
+        return current_value
+
+    def get_state_internal(self, group_id: int, max_age: Optional[float] = 0) -> Union[bool, bool]:
+        self.ensure_max_age(group_id, max_age)
         g_state = self.groups[group_id].state
         _, states, _ = self.get_hex_color_dimmer_state_light_control(self.group_members[group_id])
         return any(states), g_state
 
-    def get_dimmer(self, group_id: int, refresh_data=True) -> int:
-        current_value, _ = self.get_dimmer_internal(group_id, refresh_data)
+    def get_dimmer(self, group_id: int, max_age: Optional[float] = 0) -> int:
+        current_value, _ = self.get_dimmer_internal(group_id, max_age)
         return current_value
 
-    def get_dimmer_internal(self, group_id: int, refresh_data=True) -> Union[int, int]:
-        if refresh_data:
-            self.load_group(group_id)
+    def get_dimmer_internal(self, group_id: int, max_age: Optional[float] = 0) -> Union[int, int]:
+        self.ensure_max_age(group_id, max_age)
         g_dim_value = self.groups[group_id].dimmer
         _, _, dim_values = self.get_hex_color_dimmer_state_light_control(self.group_members[group_id])
         # If someone used the normal remote, the dim values of the group and the lights within the
@@ -142,48 +370,140 @@ class TradfriHandler:
         return dim_values[0], g_dim_value
 
     def get_groups(self) -> Iterable[Group]:
-        # Only update every 5 minutes at most
-        if (len(self.groups) == 0 or not self.groups_last_updated or
-            datetime.now() > self.groups_last_updated + timedelta(minutes=5)):
-            self.load_groups()
+        if len(self.groups) == 0:
+            self.refresh_groups()
+        elif (not self.groups_last_updated or
+              datetime.now() > self.groups_last_updated + timedelta(seconds=MAX_GROUPS_AGE_SECONDS)):
+            # Serve the cached groups and reload them in the background
+            Thread(target=self.refresh_groups, daemon=True).start()
         return self.groups.values()
 
-    def set_state(self, group_id: int, new_state: bool) -> bool:
+    def set_state(self, group_id: int, new_state: bool) -> CommandResult:
         # Thanks IKEA!
+        def send() -> CommandResult:
+            return self.run_api_command_for_group(lambda lg: lg.set_state(new_state),
+                                                  lambda lg: self.update_group(lg, 'state', int(new_state)),
+                                                  group_id)
+
+        def is_converged() -> bool:
+            current_state, g_state = self.get_state_internal(group_id, None)
+            return current_state == g_state
+
+        return self.reconcile("state", group_id, send, is_converged)
+
+    def set_dimmer(self, group_id: int, value: int) -> CommandResult:
+        target = DimmerTarget(value)
+
+        def send() -> CommandResult:
+            return self.run_api_command_for_group(lambda lg: lg.set_dimmer(target.try_value, transition_time=1),
+                                                  lambda lg: self.update_group(lg, 'dimmer', target.try_value),
+                                                  group_id)
+
+        def is_converged() -> bool:
+            return target.is_converged(*self.get_dimmer_internal(group_id, None))
+
+        return self.reconcile("dimmer", group_id, send, is_converged)
+
+    # Sends the command until the group and its lights agree, with an exponential
+    # backoff between the attempts and both an attempt and a time limit
+    def reconcile(self,
+                  command_name: str,
+                  group_id: int,
+                  send: Callable[[], CommandResult],
+                  is_converged: Callable[[], bool]) -> CommandResult:
+        start = time.monotonic()
+        deadline = start + RECONCILE_DEADLINE_SECONDS
+        delay = RECONCILE_INITIAL_DELAY_SECONDS
+        attempts = 0
         while True:
-            success = self.run_api_command_for_group(lambda lg: lg.set_state(new_state),
-                                                     lambda lg: self.update_group(lg, 'state', int(new_state)),
-                                                     group_id)
-            if not success:
-                return False
-            time.sleep(0.1)
-            current_state, g_state = self.get_state_internal(group_id, True)
-            if current_state == g_state:
+            attempts += 1
+            result = send()
+            if result != CommandResult.OK:
+                break
+            time.sleep(max(0, min(delay, deadline - time.monotonic())))
+            # Always ask the gateway, the cached values of an observed group
+            # include the ones send just wrote locally
+            self.load_group(group_id)
+            if is_converged():
                 break
-        return True
 
-    def set_dimmer(self, group_id: int, value: int) -> bool:
-        # Thanks IKEA!
-        try_value = value
-        while True:
-            success = self.run_api_command_for_group(lambda lg: lg.set_dimmer(try_value, transition_time=1),
-                                                     lambda lg: self.update_group(lg, 'dimmer', try_value),
-                                                     group_id)
-            if not success:
-                return False
-            time.sleep(0.1)
-            get_val, g_get_val = self.get_dimmer_internal(group_id, True)
-            if get_val == g_get_val:
+            result = CommandResult.NOT_CONVERGED
+            if attempts >= RECONCILE_MAX_ATTEMPTS or time.monotonic() >= deadline:
+                self.logger.error("Trådfri group {} did not converge for {} after {} attempts"
+                                  .format(group_id, command_name, attempts))
                 break
+            delay *= 2
 
-            if try_value == g_get_val:
-                if try_value == value:
-                    try_value -= 1
-                else:
-                    try_value = value
-        return True
+        self.command_stats[command_name].record(attempts, time.monotonic() - start, result)
+        return result
+
+    # Applies light-state, color and dimmer values to several groups at once. The
+    # values of each group are merged into a single gateway command.
+    def apply_batch(self, device_config: dict) -> dict[int, dict]:
+        def apply(group_id: int, values: dict) -> dict:
+            start = time.monotonic()
+            result = self.set_group_values(group_id, values)
+            return {"result": result.value, "time": time.monotonic() - start}
+
+        with ThreadPoolExecutor(max_workers=self.max_concurrent_requests) as executor:
+            futures = {int(group_id): executor.submit(apply, int(group_id), values)
+                       for group_id, values in device_config.items()}
+            return {group_id: future.result() for group_id, future in futures.items()}
+
+    def set_group_values(self, group_id: int, values: dict) -> CommandResult:
+        raw_values = {}
+        updates = {}
+        if "light-state" in values:
+            updates["state"] = int(bool(values["light-state"]))
+            raw_values[ATTR_DEVICE_STATE] = updates["state"]
+        if "color" in values:
+            updates["color_hex"] = values["color"].lstrip('#')
+            raw_values[ATTR_LIGHT_COLOR_HEX] = updates["color_hex"]
+        target = None
+        if "dimmer" in values:
+            target = DimmerTarget(int(values["dimmer"]))
+            updates["dimmer"] = target.value
+            raw_values[ATTR_LIGHT_DIMMER] = target.value
+        if not raw_values:
+            return CommandResult.OK
+        if "color_hex" in updates or "dimmer" in updates:
+            raw_values[ATTR_TRANSITION_TIME] = 1
 
-    def set_hex_color(self, group_id: int, value: str) -> bool:
+        def send() -> CommandResult:
+            if target is not None:
+                updates["dimmer"] = raw_values[ATTR_LIGHT_DIMMER] = target.try_value
+            return self.run_api_command_for_group(lambda lg: lg.set_values(raw_values),
+                                                  lambda lg: [self.update_group(lg, key, value)
+                                                              for key, value in updates.items()],
+                                                  group_id)
+
+        def is_converged() -> bool:
+            if "state" in updates:
+                current_state, g_state = self.get_state_internal(group_id, None)
+                if current_state != g_state:
+                    return False
+            if target is not None:
+                return target.is_converged(*self.get_dimmer_internal(group_id, None))
+            return True
+
+        return self.reconcile("batch", group_id, send, is_converged)
+
+    def export_command_stats(self) -> dict:
+        return {name: stats.export() for name, stats in self.command_stats.items()}
+
+    # The command stats and the seconds the last refresh of all groups took
+    def export_stats(self) -> dict:
+        return {
+            "commands": self.export_command_stats(),
+            "refresh": {
+                "timings": {name: round(seconds, 3) for name, seconds in self.refresh_timings.items()},
+                "groups": len(self.groups),
+                "last-updated": self.groups_last_updated.isoformat(timespec="seconds")
+                                if self.groups_last_updated else None
+            }
+        }
+
+    def set_hex_color(self, group_id: int, value: str) -> CommandResult:
         return self.run_api_command_for_group(lambda lg: lg.set_hex_color(value, transition_time=1),
                                               lambda lg: self.update_group(lg, 'color_hex', value),
                                               group_id)
@@ -191,16 +511,16 @@ class TradfriHandler:
     def run_api_command_for_group(self,
                                   command_function: Callable[[Group], Command],
                                   update_function: Callable[[Group], None],
-                                  group_id: int) -> bool:
+                                  group_id: int) -> CommandResult:
         if group_id not in self.groups:
-            return False
+            return CommandResult.NOT_FOUND
         light_group = self.groups[group_id]
         try:
             self.api(command_function(light_group))
         except RequestTimeout:
-            return False
+            return CommandResult.FAILED
         update_function(light_group)
-        return True
+        return CommandResult.OK
 
     # This is a bit hacky, but allows to update the state of the device without
     # refetching it through the gateway
@@ -212,3 +532,114 @@ class TradfriHandler:
                 continue
             for light in member.light_control.lights:
                 setattr(light.raw, key, new_value)
+        self.invalidate_export()
+
+
+# Observes all groups and lights over a single DTLS session, from one thread
+# running an asyncio event loop
+class TradfriObserver:
+    def __init__(self, handler: TradfriHandler, logger: Logger, api: Callable = None,
+                 credentials: Optional[Tuple[str, str, str]] = None,
+                 retry_delay: float = OBSERVE_RETRY_SECONDS,
+                 max_retry_delay: float = OBSERVE_MAX_RETRY_SECONDS):
+        self.handler = handler
+        self.logger = logger
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.lock = Lock()
+        self.observed: set[Tuple[str, int]] = set()
+        # Whether the observation of a group or device is currently running
+        self.alive: dict[Tuple[str, int], bool] = {}
+        self.loop = asyncio.new_event_loop()
+        # Starting every observation at once would flood the gateway
+        self.starting = asyncio.Semaphore(handler.max_concurrent_requests)
+        Thread(target=self.loop.run_forever, daemon=True).start()
+        if api is None:
+            host, identity, psk = credentials
+            api = asyncio.run_coroutine_threadsafe(
+                AsyncAPIFactory.init(host=host, psk_id=identity, psk=psk), self.loop).result().request
+        self.api = api
+
+    # Ends all observations and the event loop
+    def stop(self):
+        async def cancel_all():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(cancel_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Starts observing all groups and lights that are not observed yet
+    def sync(self):
+        for group_id, members in list(self.handler.group_members.items()):
+            self.observe("group", group_id)
+            for member in members:
+                if member.has_light_control:
+                    self.observe("device", member.id)
+
+    def is_observing(self, group_id: int) -> bool:
+        if not self.alive.get(("group", group_id)):
+            return False
+        members = self.handler.group_members.get(group_id, [])
+        return all(self.alive.get(("device", member.id)) for member in members if member.has_light_control)
+
+    def observe(self, kind: str, resource_id: int):
+        key = (kind, resource_id)
+        with self.lock:
+            if key in self.observed:
+                return
+            self.observed.add(key)
+        asyncio.run_coroutine_threadsafe(self.run(kind, resource_id), self.loop)
+
+    def fetch_command(self, kind: str, resource_id: int) -> Command:
+        if kind == "group":
+            return self.handler.gateway.get_group(resource_id)
+        return self.handler.gateway.get_device(resource_id)
+
+    def on_update(self, kind: str, resource: Union[Group, Device]):
+        if kind == "group":
+            self.handler.apply_group(resource)
+        else:
+            self.handler.apply_device(resource)
+
+    async def run(self, kind: str, resource_id: int):
+        key = (kind, resource_id)
+        delay = self.retry_delay
+        while True:
+            ended = asyncio.Event()
+            errors = []
+
+            def on_error(error: Exception):
+                errors.append(error)
+                ended.set()
+
+            try:
+                async with self.starting:
+                    # Fetch the current value first, changes made while we were
+                    # not observing would otherwise be lost
+                    resource = await self.api(self.fetch_command(kind, resource_id))
+                    self.on_update(kind, resource)
+                    # Returns as soon as the gateway accepted the observation
+                    await self.api(resource.observe(lambda resource: self.on_update(kind, resource),
+                                                    on_error, duration=0))
+                self.alive[key] = True
+                started = time.monotonic()
+                await ended.wait()
+                self.alive[key] = False
+                if time.monotonic() - started >= self.max_retry_delay:
+                    delay = self.retry_delay
+                if isinstance(errors[0], (ObservationCancelled, NotObservable)):
+                    # The gateway ended the observation
+                    self.logger.info("Trådfri observation of {} {} ended, restarting in {} s"
+                                     .format(kind, resource_id, delay))
+                else:
+                    self.logger.error("Trådfri observation of {} {} failed, retrying in {} s: {}"
+                                      .format(kind, resource_id, delay, errors[0]))
+            except Exception as error:
+                self.alive[key] = False
+                self.logger.error("Trådfri observation of {} {} failed, retrying in {} s: {}"
+                                  .format(kind, resource_id, delay, error))
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_retry_delay)
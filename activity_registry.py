@@ -0,0 +1,101 @@
+import copy
+from logging import Logger
+from threading import Lock
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from channel_handler import ChannelHandler
+
+class BoundCode(NamedTuple):
+    handler: ChannelHandler
+    channel: str
+    data: Union[str, dict]
+
+class Step(NamedTuple):
+    # Seconds to wait before the step
+    delay: float
+    # Codes for different channels are sent in parallel, codes for the same channel in order
+    codes: List[BoundCode]
+
+class RegisteredActivity(NamedTuple):
+    group: str
+    index: int
+    name: str
+    steps: List[Step]
+
+class ActivityRegistry:
+    def __init__(self, channel_handlers: Dict[str, ChannelHandler], logger: Logger):
+        self.channel_handlers = channel_handlers
+        self.logger = logger
+        self.lock = Lock()
+        self.by_name: Dict[Tuple[str, str], RegisteredActivity] = {}
+        self.by_index: Dict[Tuple[str, int], RegisteredActivity] = {}
+        # Copy of the configuration each group was compiled from, used to only
+        # recompile the groups that actually changed when the config is saved
+        self.group_sources: Dict[str, dict] = {}
+
+    def load(self, activities: dict):
+        groups = {group["name"]: group for group in activities["groups"]}
+        with self.lock:
+            for name in [name for name in self.group_sources if name not in groups]:
+                self.remove_group(name)
+
+            for name, group in groups.items():
+                if self.group_sources.get(name) != group:
+                    self.remove_group(name)
+                    self.compile_group(group)
+
+    def compile_group(self, group: dict):
+        group_name = group["name"]
+        for index, activity in enumerate(group["activities"]):
+            registered = RegisteredActivity(group_name, index, activity["name"],
+                                            self.compile_steps(activity["codes"]))
+            self.by_index[(group_name, index)] = registered
+            # Keep the first activity if there are duplicate names, just like the linear scan did
+            self.by_name.setdefault((group_name, activity["name"]), registered)
+        self.group_sources[group_name] = copy.deepcopy(group)
+
+    # The codes of an activity are sent one after another. An entry can wait before it is
+    # sent with "delay" in seconds, {"delay": 2} only waits, and {"parallel": [...]} sends
+    # the codes in it at the same time, keeping the order of codes for the same channel.
+    def compile_steps(self, codes: List[dict]) -> List[Step]:
+        steps = []
+        for code_configuration in codes:
+            delay = float(code_configuration.get("delay", 0))
+            if "parallel" in code_configuration:
+                steps.append(Step(delay, self.compile_codes(code_configuration["parallel"])))
+            elif "channel" in code_configuration:
+                steps.append(Step(delay, self.compile_codes([code_configuration])))
+            else:
+                steps.append(Step(delay, []))
+        return steps
+
+    def compile_codes(self, codes: List[dict]) -> List[BoundCode]:
+        bound_codes = []
+        for code_configuration in codes:
+            channel = code_configuration["channel"]
+            if channel not in self.channel_handlers:
+                self.logger.error("Channel {} not found!".format(channel))
+                continue
+            if not self.channel_handlers[channel].accepts(channel, code_configuration["data"]):
+                self.logger.error("Unknown code {} for channel {}!".format(code_configuration["data"], channel))
+                continue
+            bound_codes.append(BoundCode(self.channel_handlers[channel], channel, code_configuration["data"]))
+        return bound_codes
+
+    def remove_group(self, group_name: str):
+        source = self.group_sources.pop(group_name, None)
+        if source is None:
+            return
+        for index, activity in enumerate(source["activities"]):
+            self.by_index.pop((group_name, index), None)
+            self.by_name.pop((group_name, activity["name"]), None)
+
+    def get(self, group: str, index: int) -> Optional[RegisteredActivity]:
+        return self.by_index.get((group, index))
+
+    def find(self, group: str, name: str) -> Optional[RegisteredActivity]:
+        return self.by_name.get((group, name))
+
+    def index_of(self, group: str, name: str) -> int:
+        activity = self.find(group, name)
+        return activity.index if activity else -1
@@ -0,0 +1,59 @@
+# Writes of activities.json during a burst of 1,000 schedule toggles, written
+# on every toggle like before and by the coalescing write-behind writer.
+#
+#   python bench/bench_activities_writer.py
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import config
+
+TOGGLES = 1000
+# The paced burst spreads the toggles over this many seconds
+BURST_SECONDS = 2.0
+
+def toggle(activities: dict, index: int):
+    event = activities["scheduled"][index % len(activities["scheduled"])]
+    event.disabled = not event.disabled
+
+def run_synchronous(activities: dict, filename: str) -> tuple[float, int]:
+    writer = config.ActivitiesWriter(filename, 0)
+    start = time.perf_counter()
+    for index in range(TOGGLES):
+        toggle(activities, index)
+        writer.write(activities)
+    return time.perf_counter() - start, writer.writes
+
+def run_write_behind(activities: dict, filename: str, pause: float) -> tuple[float, int]:
+    writer = config.ActivitiesWriter(filename, config.SAVE_DEBOUNCE_SECONDS)
+    start = time.perf_counter()
+    for index in range(TOGGLES):
+        toggle(activities, index)
+        writer.mark_dirty(activities)
+        if pause:
+            time.sleep(pause)
+    writer.flush()
+    return time.perf_counter() - start, writer.writes
+
+def report(name: str, elapsed: float, writes: int):
+    print("{:<28} {:>8.3f} s {:>10.0f} toggles/s {:>6} writes {:>8.1f} writes/s"
+          .format(name, elapsed, TOGGLES / elapsed, writes, writes / elapsed))
+
+def main():
+    activities = config.get_activities(logging.getLogger(__name__))
+    if not activities["scheduled"]:
+        sys.exit("activities.json has no scheduled events to toggle")
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "activities.json")
+        print("{} toggles of {} events, debounce {} s".format(TOGGLES, len(activities["scheduled"]),
+                                                            config.SAVE_DEBOUNCE_SECONDS))
+        report("write on every toggle", *run_synchronous(activities, filename))
+        report("write-behind, all at once", *run_write_behind(activities, filename, 0))
+        report("write-behind, over {} s".format(BURST_SECONDS),
+               *run_write_behind(activities, filename, BURST_SECONDS / TOGGLES))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Exporting 50 Trådfri groups of 10 bulbs each, from the cached snapshot, when
+# the snapshot is rebuilt in one vectorized pass, and with a color average per
+# group like before the snapshot.
+#
+#   python bench/bench_export_groups.py
+import logging
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+from IKEA import TradfriHandler
+from fake_tradfri import FakeGateway
+
+GROUPS = 50
+BULBS = 10
+ROUNDS = 200
+
+# A color average per group, with the lights of the group taken one by one
+def export_per_group(handler: TradfriHandler) -> list[dict]:
+    exported = []
+    for group in handler.groups.values():
+        lights = [member.light_control.lights[0] for member in handler.group_members[group.id]
+                  if member.has_light_control]
+        colors = [bytes.fromhex(light.hex_color) for light in lights if light.hex_color]
+        color = None
+        if colors:
+            color = '#' + bytes(sum(color[channel] for color in colors) // len(colors)
+                                for channel in range(3)).hex()
+        exported.append({"name": group.name, "id": group.id, "state": any(light.state for light in lights),
+                         "dimmer": lights[0].dimmer if lights else None, "color": color})
+    return exported
+
+def measure(function) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        function()
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+def main():
+    random.seed(1)
+    gateway = FakeGateway(groups=GROUPS, lights=BULBS)
+    for device_id in gateway.devices:
+        gateway.light(device_id)["5706"] = "{:06x}".format(random.randrange(1 << 24))
+        gateway.light(device_id)["5851"] = random.randrange(255)
+    handler = TradfriHandler("gateway", "key", logging.getLogger(__name__), api=gateway)
+
+    expected = {group["id"]: group for group in export_per_group(handler)}
+    for group in handler.export_groups():
+        assert group["color"] == expected[group["id"]]["color"], group
+
+    def rebuild():
+        handler.invalidate_export()
+        handler.export_groups()
+
+    print("{} groups x {} bulbs, mean of {} rounds".format(GROUPS, BULBS, ROUNDS))
+    print("{:<32} {:>8.3f} ms".format("average per group", measure(lambda: export_per_group(handler))))
+    print("{:<32} {:>8.3f} ms".format("snapshot rebuilt in one pass", measure(rebuild)))
+    print("{:<32} {:>8.3f} ms".format("cached snapshot", measure(handler.export_groups)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Sending Sony TV and Hyperion keys to a local stub server, with a new
+# connection per key like before, and through the handlers, which reuse one
+# session and send from a single worker.
+#
+#   python bench/bench_http_channel.py
+import logging
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+
+# Use the stand-ins for the GPIO and other hardware
+os.environ.setdefault("DEBUG", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from channel_handler import HyperionWebHandler, SonyTVAPIHandler
+
+KEYS = ["Up", "Up", "Right", "Confirm"]
+ROUNDS = 100
+
+class StubDevice(BaseHTTPRequestHandler):
+    # Keep the connection open between requests, like the TV does
+    protocol_version = "HTTP/1.1"
+
+    def respond(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, *_):
+        pass
+
+# The key presses as they were sent before, one request and connection each
+def send_per_request(handler: SonyTVAPIHandler, command: str):
+    if command in handler.ircc_bodies:
+        requests.post(handler.ircc_url, data=handler.ircc_bodies[command], headers=handler.HEADERS,
+                      timeout=handler.TIMEOUT)
+    else:
+        requests.get(handler.urls[command], headers=handler.HEADERS, timeout=handler.TIMEOUT)
+
+def measure(function) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for key in KEYS:
+            function(key)
+    return (time.perf_counter() - start) / (ROUNDS * len(KEYS)) * 1000
+
+def main():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubDevice)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = "http://127.0.0.1:{}".format(server.server_address[1])
+
+    logger = logging.getLogger(__name__)
+    SonyTVAPIHandler.REQ_ADDR = address
+    HyperionWebHandler.REQ_ADDR = address
+    sony = SonyTVAPIHandler(logger=logger)
+    hyperion = HyperionWebHandler(logger=logger)
+    led = {"endpoint": "effect", "data": {"name": "Rainbow"}}
+
+    print("{} x {} keys, {}".format(ROUNDS, "/".join(KEYS), address))
+    print("{:<32} {:>8.3f} ms/key".format("new connection per key", measure(lambda key: send_per_request(sony, key))))
+    print("{:<32} {:>8.3f} ms/key".format("Sony session and queue", measure(lambda key: sony.handle_code("SONY", key))))
+    print("{:<32} {:>8.3f} ms/key".format("Hyperion session and queue", measure(lambda _: hyperion.handle_code("LED", led))))
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
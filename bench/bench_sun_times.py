@@ -0,0 +1,58 @@
+# Looking up whether it is dark once per scheduler check, with the city lookup
+# and the sunrise/sunset computation on every call like before, and with the
+# window that SunTimes computes once.
+#
+#   python bench/bench_sun_times.py
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Tuple
+import pytz
+from astral.geocoder import lookup, database
+from astral.location import Location
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from sun_times import SunTimes
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+# One check every 10 minutes during a week
+CHECKS = 7 * 24 * 6
+
+# The lookup the scheduler did before, for the time it is given
+def get_sun_info_per_call(timezone: pytz.timezone, now: datetime) -> Tuple[bool, timedelta]:
+    city = Location(lookup(timezone.zone.split('/')[1], database()))
+    today = now.date()
+    sun = city.sun(date=today, local=True)
+    if sun["sunrise"] <= now <= sun["sunset"]:
+        return (False, sun["sunset"] - now)
+    if now < sun["sunrise"]:
+        return (True, sun["sunrise"] - now)
+    sun_tomorrow = city.sun(date=today + timedelta(days=1), local=True)
+    return (True, sun_tomorrow["sunrise"] - now)
+
+def measure(function, times: list[datetime]) -> float:
+    start = time.perf_counter()
+    for now in times:
+        function(now)
+    return (time.perf_counter() - start) / len(times) * 1000000
+
+def main():
+    start = TIMEZONE.localize(datetime(2024, 3, 1))
+    times = [start + timedelta(minutes=10 * check) for check in range(CHECKS)]
+    sun_times = SunTimes(TIMEZONE)
+
+    for now in times:
+        is_dark, timediff = sun_times.get_sun_info(now)
+        expected_dark, expected_timediff = get_sun_info_per_call(TIMEZONE, now)
+        assert is_dark == expected_dark, now
+        assert abs(timediff - expected_timediff) < timedelta(seconds=1), now
+
+    print("{} checks, every 10 minutes during a week".format(CHECKS))
+    print("{:<32} {:>8.1f} us/check".format("lookup and compute per call",
+                                            measure(lambda now: get_sun_info_per_call(TIMEZONE, now), times)))
+    print("{:<32} {:>8.1f} us/check".format("first window", measure(SunTimes(TIMEZONE).get_sun_info, times)))
+    print("{:<32} {:>8.1f} us/check".format("computed window", measure(sun_times.get_sun_info, times)))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,22 @@
+import inspect
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ConnectionError
+from concurrent.futures import Future, ThreadPoolExecutor
 import wakeonlan as wol
-from typing import Union, List
+from typing import Callable, Union, List
 from abc import ABC, abstractmethod
 from util import load_json_file, is_debug
-from threading import Semaphore
+from lircd import LircdClient, LircdError
+from collections import deque
+from threading import Condition, Lock, Thread
+import itertools
+import time
 
 if not is_debug():
     import atexit
     from rpi_rf import RFDevice
-    import lirc
 
 class ChannelHandler(ABC):
     def __init__(self, channels: List[str], logger: logging.Logger):
@@ -21,6 +27,20 @@ class ChannelHandler(ABC):
     def handle_code(self, channel: str, data: Union[str, dict]):
         pass
 
+    # Whether the data is a valid code, checked when activities are loaded
+    def accepts(self, channel: str, data: Union[str, dict]) -> bool:
+        return True
+
+    # All handler classes that can be created, including those inheriting from other handlers
+    @classmethod
+    def concrete_subclasses(cls) -> List[type]:
+        subclasses = []
+        for subclass in cls.__subclasses__():
+            if not inspect.isabstract(subclass):
+                subclasses.append(subclass)
+            subclasses.extend(subclass.concrete_subclasses())
+        return subclasses
+
 class WakeOnLanHandler(ChannelHandler):
     def __init__(self, **kwargs):
         super().__init__(["WOL"], **kwargs)
@@ -28,57 +48,96 @@ class WakeOnLanHandler(ChannelHandler):
     def handle_code(self, _: str, data: Union[str, dict]):
         wol.send_magic_packet(data)
 
-class HyperionWebHandler(ChannelHandler):
+class HTTPChannelHandler(ChannelHandler):
+    # Seconds to wait for the connection and for the response
+    TIMEOUT = (2, 5)
+
+    def __init__(self, channels: List[str], **kwargs):
+        super().__init__(channels, **kwargs)
+        # Reuse the connection to the device between commands
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        # A single worker sends the requests in the order they were made
+        self.queue = ThreadPoolExecutor(max_workers=1)
+
+    def handle_code(self, channel: str, data: Union[str, dict]):
+        return self.queue.submit(self.send_code, channel, data).result()
+
+    @abstractmethod
+    def send_code(self, channel: str, data: Union[str, dict]):
+        pass
+
+class HyperionWebHandler(HTTPChannelHandler):
     REQ_ADDR = "http://localhost:1234"
 
     def __init__(self, **kwargs):
         super().__init__(["LED"], **kwargs)
 
-    def handle_code(self, _, data: dict):
+    def send_code(self, _, data: dict):
         try:
-            requests.post(self.REQ_ADDR + "/" + data["endpoint"], data=data["data"])
+            self.session.post(self.REQ_ADDR + "/" + data["endpoint"], data=data["data"], timeout=self.TIMEOUT)
         except (ConnectionError, requests.Timeout):
             self.logger.error("HyperionWeb unavailable (503)")
             pass
 
-class SonyTVAPIHandler(ChannelHandler):
+class SonyTVAPIHandler(HTTPChannelHandler):
     REQ_ADDR = "http://192.168.1.140"
     # This list of commands is based on the response from a Sony TV when
     # calling the cers/api/getRemoteCommandList endpoint.
     COMMANDS = load_json_file("sony_bravia.json")
     HEADERS = {"X-CERS-DEVICE-ID": "rpi", "X-CERS-DEVICE-INFO": "Linux/Python", 'Content-Type': 'application/xml'}
-
-    def __init__(self, **kwargs):
-        super().__init__(["SONY"], **kwargs)
-
-    def handle_code(self, _, command: str):
-        if command not in self.COMMANDS:
-            return False
-        command_info = self.COMMANDS[command]
-        try:
-            if command_info["type"] == "ircc":
-                data = """<?xml version="1.0"?>
+    IRCC_ENVELOPE = """<?xml version="1.0"?>
 <s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">
   <s:Body>
     <u:X_SendIRCC xmlns:u="urn:schemas-sony-com:service:IRCC:1">
       <IRCCCode>%s</IRCCCode>
     </u:X_SendIRCC>
   </s:Body>
-</s:Envelope>""" % (command_info["value"])
-                requests.post(self.REQ_ADDR + "/IRCC", data=data, headers=self.HEADERS)
-            elif command_info["type"] == "url":
-                requests.get(self.REQ_ADDR + command_info["value"], headers=self.HEADERS)
+</s:Envelope>"""
+
+    def __init__(self, **kwargs):
+        super().__init__(["SONY"], **kwargs)
+        self.session.headers.update(self.HEADERS)
+        self.power_monitor = SonyPowerMonitor(self.probe_is_on)
+        self.ircc_url = self.REQ_ADDR + "/IRCC"
+        # Request bodies and URLs are built once instead of on every key press
+        self.ircc_bodies: dict[str, bytes] = {}
+        self.urls: dict[str, str] = {}
+        for command, command_info in self.COMMANDS.items():
+            if not isinstance(command_info, dict) or not isinstance(command_info.get("value"), str):
+                self.logger.error("Invalid Sony command {}: {}".format(command, command_info))
+            elif command_info.get("type") == "ircc":
+                self.ircc_bodies[command] = (self.IRCC_ENVELOPE % command_info["value"]).encode("utf-8")
+            elif command_info.get("type") == "url":
+                self.urls[command] = self.REQ_ADDR + command_info["value"]
+            else:
+                self.logger.error("Unknown type of Sony command {}: {}".format(command, command_info.get("type")))
+
+    def export_commands(self) -> dict[str, dict]:
+        return {command: self.COMMANDS[command] for command in [*self.ircc_bodies, *self.urls]}
+
+    def send_code(self, _, command: str):
+        # Keys like the power button change the state, so check it more often for a while
+        self.power_monitor.boost()
+        try:
+            if command in self.ircc_bodies:
+                self.session.post(self.ircc_url, data=self.ircc_bodies[command], timeout=self.TIMEOUT)
+            elif command in self.urls:
+                self.session.get(self.urls[command], timeout=self.TIMEOUT)
+            else:
+                return False
         except (ConnectionError, requests.Timeout):
             self.logger.error("Sony TV unavailable (503)")
             pass
 
-    @classmethod
     def is_on(self) -> bool:
+        return self.power_monitor.is_on
+
+    def probe_is_on(self) -> bool:
         try:
             # When the TV has been in standby for some minutes,
             # it is no longer responding, hence the short timeout
-            response = requests.get(self.REQ_ADDR + "/cers/api/getStatus",
-                                    headers=self.HEADERS, timeout=1)
+            response = self.session.get(self.REQ_ADDR + "/cers/api/getStatus", timeout=SonyPowerMonitor.PROBE_TIMEOUT)
         except (ConnectionError, requests.Timeout):
             pass
             return False
@@ -87,12 +146,170 @@ class SonyTVAPIHandler(ChannelHandler):
         return "ExtInput" in response.content.decode("utf-8")
 
 
+class SonyPowerMonitor:
+    # Seconds between probes when nothing happens, and right after a command or a change
+    SLOW_INTERVAL = 30
+    FAST_INTERVAL = 2
+    # For how long to probe fast after a command or a change
+    FAST_PERIOD = 60
+    # Seconds a probe takes at most, a TV in standby does not respond at all
+    PROBE_TIMEOUT = 1
+
+    def __init__(self, probe: Callable[[], bool]):
+        self.probe = probe
+        self.condition = Condition()
+        self.is_on = False
+        self.last_updated = None
+        # When the probe that last_updated comes from was started
+        self.last_probe_started = None
+        self.fast_until = 0
+        self.probe_now = False
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Probe more often for a while, for example after a command was sent to the TV
+    def boost(self):
+        with self.condition:
+            self.fast_until = time.monotonic() + self.FAST_PERIOD
+            self.probe_now = True
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            started = time.monotonic()
+            is_on = self.probe()
+            with self.condition:
+                if is_on != self.is_on:
+                    self.fast_until = time.monotonic() + self.FAST_PERIOD
+                self.is_on = is_on
+                self.last_updated = time.monotonic()
+                self.last_probe_started = started
+                self.condition.notify_all()
+
+                fast = time.monotonic() < self.fast_until
+                self.condition.wait_for(lambda: self.probe_now,
+                                        timeout=self.FAST_INTERVAL if fast else self.SLOW_INTERVAL)
+                self.probe_now = False
+
+    # Seconds since the state was last probed
+    def get_age(self) -> float:
+        if self.last_updated is None:
+            return float("inf")
+        return time.monotonic() - self.last_updated
+
+    # Waits at most the delay for the TV to reach the required state, and
+    # returns whether it did. Only probes started after the call count, since the
+    # cached state may be from before the TV changed. When the delay is over, the
+    # TV is probed once more, like sleeping for the delay and then probing did.
+    def wait_for_state(self, required: bool, delay: float) -> bool:
+        with self.condition:
+            called = time.monotonic()
+            # Probe right away rather than waiting for the next interval
+            self.fast_until = called + self.FAST_PERIOD
+            self.probe_now = True
+            self.condition.notify_all()
+            if self.condition.wait_for(lambda: self.probed_since(called) and self.is_on == required,
+                                       timeout=delay):
+                return True
+
+            last_chance = time.monotonic()
+            self.probe_now = True
+            self.condition.notify_all()
+            # A probe that was already running has to finish before the new one
+            # starts, with some slack for a slow response
+            self.condition.wait_for(lambda: self.probed_since(last_chance), timeout=3 * self.PROBE_TIMEOUT)
+            return self.probed_since(last_chance) and self.is_on == required
+
+    def probed_since(self, since: float) -> bool:
+        return self.last_probe_started is not None and self.last_probe_started >= since
+
+
+class RFTransmitter:
+    def __init__(self, device):
+        self.device = device
+        self.condition = Condition()
+        # (sequence number, socket) for the sockets waiting to be sent, in the order
+        # they were requested. Codes are never reordered, since a code for all
+        # sockets and one for a single socket have to be sent in the order given.
+        self.queue = deque()
+        self.sequence = itertools.count()
+        # Socket -> [sequence number, code, protocol, pulse length, repeat, futures].
+        # Only the last requested code of each socket is sent.
+        self.pending: dict[tuple, list] = {}
+        self.sent = 0
+        self.collapsed = 0
+        self.total_airtime = 0.0
+        # Code -> estimated seconds it takes to transmit it
+        self.airtime: dict[int, float] = {}
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, socket: tuple, code: int, protocol: int, pulse_length: int, repeat: int,
+             airtime: float) -> Future:
+        future = Future()
+        with self.condition:
+            self.airtime[code] = airtime
+            sequence = next(self.sequence)
+            if socket in self.pending:
+                # Not sent yet, replace the code and let all callers wait for the new one.
+                # It moves to the back of the queue so that it is still sent after
+                # codes that were queued in between, for example for all sockets.
+                self.pending[socket][0] = sequence
+                self.pending[socket][1:5] = [code, protocol, pulse_length, repeat]
+                self.pending[socket][5].append(future)
+                self.collapsed += 1
+            else:
+                self.pending[socket] = [sequence, code, protocol, pulse_length, repeat, [future]]
+            self.queue.append((sequence, socket))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.queue)
+                sequence, socket = self.queue.popleft()
+                if socket not in self.pending or self.pending[socket][0] != sequence:
+                    # Superseded by a later code for the same socket
+                    continue
+                _, code, protocol, pulse_length, repeat, futures = self.pending.pop(socket)
+
+            try:
+                self.device.tx_repeat = repeat
+                self.device.tx_code(code, protocol, pulse_length)
+            except Exception as error:
+                for future in futures:
+                    future.set_exception(error)
+            else:
+                with self.condition:
+                    self.sent += 1
+                    self.total_airtime += self.airtime[code]
+                for future in futures:
+                    future.set_result(code)
+
+    def export_stats(self) -> dict:
+        with self.condition:
+            return {
+                "queued": len(self.pending),
+                "sent": self.sent,
+                "collapsed": self.collapsed,
+                "airtime": round(self.total_airtime, 3),
+                "codes": {str(code): round(airtime, 3) for code, airtime in self.airtime.items()}
+            }
+
+
 class MHZ433Base(ABC):
     GPIO_PIN = 2
     PROTOCOL = 0
     PULSE_LENGTH = 0
-
-    semaphore = Semaphore(1)
+    REPEAT = 0
+    # Length of a code and of the sync at the end of it, in pulses
+    CODE_BITS = 24
+    PULSES_PER_BIT = 4
+    SYNC_PULSES = 32
+    STATES = ["ON", "OFF"]
 
     if not is_debug():
         GPIO_DEVICE = RFDevice(GPIO_PIN)
@@ -105,19 +322,49 @@ class MHZ433Base(ABC):
             tx_repeat = 0
         )
 
-    @staticmethod
-    def split_data(data: str) -> Union[int, bool]:
-        new_state, device = data.split(' ')
-        return int(device) - 1, new_state == "OFF"
+    # All transmissions share the one transmitter
+    transmitter = RFTransmitter(GPIO_DEVICE)
 
-    def send_code(self, code: int, repeat: int):
-        self.semaphore.acquire()
-        self.GPIO_DEVICE.tx_repeat = repeat
-        self.GPIO_DEVICE.tx_code(code, self.PROTOCOL, self.PULSE_LENGTH)
-        self.semaphore.release()
+    # Socket name -> (ON code, OFF code) for every socket the handler can address
+    @abstractmethod
+    def get_sockets(self) -> dict[str, tuple[int, int]]:
+        pass
+
+    # Command such as "ON 1" -> (socket, code). Names of the same socket
+    # share the socket, which is identified by its ON code.
+    def build_commands(self) -> dict[str, tuple[tuple, int]]:
+        commands = {}
+        for name, codes in self.get_sockets().items():
+            socket = (type(self).__name__, codes[0])
+            for state, code in zip(self.STATES, codes):
+                commands["{} {}".format(state, name)] = (socket, code)
+        return commands
+
+    def export_sockets(self) -> List[str]:
+        return list(self.get_sockets())
+
+    def accepts(self, _: str, data: Union[str, dict]) -> bool:
+        return data in self.commands
+
+    # Waits until the code was transmitted, so that the activity's duration and
+    # errors include the transmission
+    def handle_code(self, _: str, command: str):
+        if command not in self.commands:
+            raise ValueError("Unknown command {}".format(command))
+        socket, code = self.commands[command]
+        self.send_code(socket, code, self.REPEAT).result()
+
+    # Estimated seconds it takes to transmit a code
+    def get_airtime(self, repeat: int) -> float:
+        pulses = self.CODE_BITS * self.PULSES_PER_BIT + self.SYNC_PULSES
+        return repeat * pulses * self.PULSE_LENGTH / 1000000
+
+    def send_code(self, socket: tuple, code: int, repeat: int) -> Future:
+        return self.transmitter.send(socket, code, self.PROTOCOL, self.PULSE_LENGTH,
+                                     repeat, self.get_airtime(repeat))
 
 
-class RC5Handler(ChannelHandler, MHZ433Base):
+class RC5Handler(MHZ433Base, ChannelHandler):
     PROTOCOL = 1
     PULSE_LENGTH = 420
     REPEAT = 8
@@ -142,17 +389,19 @@ class RC5Handler(ChannelHandler, MHZ433Base):
             (5525845, 5525844), # 4-3
             (5526613, 5526612)  # 4-4
         ]
+        self.commands = self.build_commands()
 
-    def handle_code(self, _, command: str):
-        device_index, new_state = super().split_data(command)
-        code = self.codes[device_index][new_state]
-        super().send_code(code, self.REPEAT)
+    def get_sockets(self) -> dict[str, tuple[int, int]]:
+        return {str(index + 1): codes for index, codes in enumerate(self.codes)}
 
 
-class NexaHandler(ChannelHandler, MHZ433Base):
+class NexaHandler(MHZ433Base, ChannelHandler):
     PROTOCOL = 6
     PULSE_LENGTH = 250
     REPEAT = 3
+    CODE_BITS = 32
+    PULSES_PER_BIT = 4
+    SYNC_PULSES = 11
 
     def __init__(self, **kwargs):
         super().__init__(["NEXA"], **kwargs)
@@ -160,29 +409,88 @@ class NexaHandler(ChannelHandler, MHZ433Base):
         self.nexa_channels = ["00", "01", "10", "11"]
         self.switches = ["00", "01", "10", "11"]
         self.states = ["0", "1"]
-        self.group = "0"
+        self.commands = self.build_commands()
 
-    def handle_code(self, _, command: str):
-        device_index, new_state = super().split_data(command)
-        code = int(self.controller_id + self.group + self.states[new_state] +
-                   self.nexa_channels[0] + self.switches[device_index], 2)
-        super().send_code(code, self.REPEAT)
+    def get_code(self, group: str, state: str, channel: str, switch: str) -> int:
+        return int(self.controller_id + group + state + channel + switch, 2)
+
+    # "1" to "4" are the switches of the first channel, "<channel>-<switch>" any
+    # switch of any channel, and "ALL" every switch of the controller
+    def get_sockets(self) -> dict[str, tuple[int, int]]:
+        sockets = {}
+        for channel_index, channel in enumerate(self.nexa_channels):
+            for switch_index, switch in enumerate(self.switches):
+                codes = tuple(self.get_code("0", state, channel, switch) for state in self.states)
+                if channel_index == 0:
+                    sockets[str(switch_index + 1)] = codes
+                sockets["{}-{}".format(channel_index + 1, switch_index + 1)] = codes
+        sockets["ALL"] = tuple(self.get_code("1", state, "00", "00") for state in self.states)
+        return sockets
 
 
 class LIRCHandler(ChannelHandler):
+    # Number of sequence latencies to keep for the stats
+    LATENCY_SAMPLES = 100
+
     def __init__(self, **kwargs):
         super().__init__(["IR"], **kwargs)
         if not is_debug():
-            self.client = lirc.Client()
+            self.client = LircdClient()
         else:
             import types
             self.client = types.SimpleNamespace(
-                send_once=lambda *args: print("lirc send_once: {}".format(args))
+                send_once=lambda *args: print("lirc send_once: {}".format(args)),
+                reconnects=0
             )
+        # Keys of one sequence are sent without keys of other sequences in between
+        self.lock = Lock()
+        self.latencies = deque(maxlen=self.LATENCY_SAMPLES)
+        self.sequences = 0
+        self.failures = 0
+
+    # The data is a single key, {"remote": "TV", "key": "KEY_POWER", "repeat": 0}, or a
+    # sequence of keys sent with a delay in seconds between them, for example
+    # {"remote": "TV", "keys": ["KEY_1", "KEY_2", {"key": "KEY_VOLUMEUP", "repeat": 4}], "delay": 0.3}.
+    # Returns (remote, key, repeat, delay before the next key) for every key.
+    @staticmethod
+    def parse_sequence(data: dict) -> List[tuple[str, str, int, float]]:
+        remote = data["remote"]
+        keys = data["keys"] if "keys" in data else [data]
+        sequence = []
+        for key in keys:
+            if isinstance(key, str):
+                key = {"key": key}
+            sequence.append((key.get("remote", remote), key["key"], int(key.get("repeat", data.get("repeat", 0))),
+                             float(key.get("delay", data.get("delay", 0)))))
+        return sequence
 
     def handle_code(self, _: str, data: dict):
-        try:
-            self.client.send_once(data["remote"], data["key"])
-        except lirc.exceptions.LircdCommandFailureError as error:
-            self.logger.error('Unable to request LIRC: {}'.format(error))
-            pass
+        sequence = self.parse_sequence(data)
+        with self.lock:
+            start = time.monotonic()
+            try:
+                for index, (remote, key, repeat, delay) in enumerate(sequence):
+                    self.client.send_once(remote, key, repeat)
+                    if delay and index < len(sequence) - 1:
+                        time.sleep(delay)
+            except (LircdError, OSError) as error:
+                self.failures += 1
+                self.logger.error('Unable to request LIRC: {}'.format(error))
+                raise
+            finally:
+                self.sequences += 1
+                self.latencies.append(time.monotonic() - start)
+
+    def export_stats(self) -> dict:
+        with self.lock:
+            latencies = list(self.latencies)
+            return {
+                "sequences": self.sequences,
+                "failures": self.failures,
+                "reconnects": self.client.reconnects,
+                "latency": {
+                    "last": latencies[-1] if latencies else None,
+                    "max": max(latencies, default=None),
+                    "average": sum(latencies) / len(latencies) if latencies else None
+                }
+            }
@@ -1,19 +1,142 @@
 import os
 import json
+import time
+import atexit
+import logging
+import shutil
+import tempfile
+from threading import Condition, Lock, Thread
+from logging import Logger
+from typing import Callable, List
+from scheduled_event import ScheduledEvent
 
 # Change to directory of script so relative file references work.
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 HOLIDAY_COUNTRY = 'SE'
 TIMEZONE = 'Europe/Stockholm'
+# Position used for sunrise and sunset. If not set, the city in TIMEZONE is used.
+LATITUDE = None
+LONGITUDE = None
 
 # Name of configuration file.
 FILE_NAME = 'activities.json'
 
-def get_activities():
+# Changes made within this many seconds of each other are written to disk at once
+SAVE_DEBOUNCE_SECONDS = 1.0
+# Serializing may fail when a request changes the activities at the same time,
+# it is tried this many times before the write is given up
+MAX_EXPORT_ATTEMPTS = 5
+
+# Called with the activities every time they are saved
+save_listeners: List[Callable[[dict], None]] = []
+
+# Scheduled events in the configuration file that are invalid. They are not
+# scheduled, but written back as they were so that they can be fixed by hand.
+skipped_events: List[dict] = []
+
+def add_save_listener(listener: Callable[[dict], None]):
+    save_listeners.append(listener)
+
+class ActivitiesWriter:
+    def __init__(self, filename: str, debounce: float, logger: Logger = logging.getLogger(__name__)):
+        self.filename = filename
+        self.debounce = debounce
+        self.logger = logger
+        self.condition = Condition()
+        self.write_lock = Lock()
+        self.pending = None
+        self.writes = 0
+        self.thread = None
+
+    def mark_dirty(self, activities: dict):
+        with self.condition:
+            self.pending = activities
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.pending is None:
+                    self.condition.wait()
+            # Let more changes pile up before writing them all at once
+            time.sleep(self.debounce)
+            try:
+                self.flush()
+            except Exception as error:
+                # The next change tries again
+                self.logger.error("Unable to save the activities: {}".format(error))
+
+    def flush(self):
+        with self.write_lock:
+            with self.condition:
+                activities = self.pending
+                self.pending = None
+            if activities is None:
+                return
+            self.write(activities)
+
+    def write(self, activities: dict):
+        # Request threads may modify the activities while we serialize them,
+        # in which case we try again
+        for attempt in range(MAX_EXPORT_ATTEMPTS):
+            try:
+                exported = export_activities(activities)
+                exported["scheduled"] = exported["scheduled"] + skipped_events
+                data = json.dumps(exported, indent=2, separators=(',', ': '))
+                break
+            except RecursionError:
+                raise
+            except RuntimeError:
+                if attempt == MAX_EXPORT_ATTEMPTS - 1:
+                    raise
+
+        # Write to a temporary file and move it in place so the file is never half written
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(self.filename))
+        try:
+            with os.fdopen(fd, 'w') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            # Temporary files are only readable by the owner, keep the permissions of the old file
+            if os.path.exists(self.filename):
+                shutil.copymode(self.filename, temp_path)
+            os.replace(temp_path, self.filename)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.writes += 1
+
+writer = ActivitiesWriter(FILE_NAME, SAVE_DEBOUNCE_SECONDS)
+atexit.register(lambda: writer.flush())
+
+def get_activities(logger: Logger):
     with open(FILE_NAME) as file:
-        return json.load(file)
+        activities = json.load(file)
+    scheduled = []
+    skipped_events.clear()
+    for event in activities.get("scheduled", []):
+        try:
+            scheduled.append(ScheduledEvent(event))
+        except (AttributeError, ValueError) as error:
+            logger.error("Skipping scheduled event: {}".format(error))
+            skipped_events.append(event)
+    activities["scheduled"] = scheduled
+    return activities
+
+# The activities as they are stored in the configuration file
+def export_activities(activities: dict) -> dict:
+    return dict(activities, scheduled=[event.to_dict() for event in activities["scheduled"]])
 
 def save_activities(activities):
-    with open(FILE_NAME, 'w') as file:
-        json.dump(activities, file, indent=2, separators=(',', ': '))
+    writer.mark_dirty(activities)
+
+    for listener in save_listeners:
+        listener(activities)
+
+def flush_activities():
+    writer.flush()
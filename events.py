@@ -0,0 +1,92 @@
+from logging import Logger
+from queue import Empty, Full, Queue
+from threading import Condition, Lock, Thread
+from typing import Callable, Optional, Tuple
+
+# Seconds between two snapshots of the state, no matter how many subscribers there are
+POLL_INTERVAL_SECONDS = 1
+# Every subscriber holds a server thread, so only allow a few at a time
+MAX_SUBSCRIBERS = 8
+# Messages a subscriber may fall behind before it is sent the whole state again
+MAX_QUEUED_MESSAGES = 32
+
+# Takes snapshots of the state from a single thread and sends what changed to every subscriber
+class EventHub:
+    def __init__(self,
+                 logger: Logger,
+                 snapshot: Callable[[], dict],
+                 interval: float = POLL_INTERVAL_SECONDS,
+                 max_subscribers: int = MAX_SUBSCRIBERS):
+        self.logger = logger
+        self.snapshot = snapshot
+        self.interval = interval
+        self.max_subscribers = max_subscribers
+        self.condition = Condition()
+        self.changed = False
+        self.lock = Lock()
+        self.state: dict = {}
+        self.subscribers: list[Queue] = []
+
+    def start(self):
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Takes the next snapshot right away, for example after something was changed through the API
+    def notify(self):
+        with self.condition:
+            self.changed = True
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            try:
+                self.publish(self.snapshot())
+            except Exception:
+                self.logger.exception("Unable to take a snapshot of the state")
+            with self.condition:
+                self.condition.wait_for(lambda: self.changed, timeout=self.interval)
+                self.changed = False
+
+    def publish(self, state: dict):
+        with self.lock:
+            # Keys that disappeared are sent as None
+            delta = {key: value for key, value in state.items() if self.state.get(key) != value}
+            delta.update({key: None for key in self.state if key not in state})
+            self.state = state
+            if not delta:
+                return
+            for queue in self.subscribers:
+                try:
+                    queue.put_nowait(("delta", delta))
+                except Full:
+                    self.resync(queue)
+
+    def resync(self, queue: Queue):
+        try:
+            while True:
+                queue.get_nowait()
+        except Empty:
+            pass
+        queue.put_nowait(("snapshot", self.state))
+
+    # Returns the queue of messages for the new subscriber, starting with the whole
+    # state, or None if there are too many subscribers already
+    def subscribe(self) -> Optional[Queue]:
+        with self.lock:
+            if len(self.subscribers) >= self.max_subscribers:
+                return None
+            queue = Queue(maxsize=MAX_QUEUED_MESSAGES)
+            queue.put_nowait(("snapshot", self.state))
+            self.subscribers.append(queue)
+            return queue
+
+    def unsubscribe(self, queue: Queue):
+        with self.lock:
+            if queue in self.subscribers:
+                self.subscribers.remove(queue)
+
+    def get(self, queue: Queue, timeout: float) -> Optional[Tuple[str, dict]]:
+        try:
+            return queue.get(timeout=timeout)
+        except Empty:
+            return None
@@ -0,0 +1,111 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime
+from logging import Logger
+from threading import BoundedSemaphore, Lock
+from typing import Callable, Iterable, Optional
+import time
+
+class QueueFullError(Exception):
+    pass
+
+class OrderedExecutor:
+    # How many lateness samples to keep for the metrics
+    LATENESS_SAMPLES = 100
+
+    def __init__(self,
+                 logger: Logger,
+                 max_workers: int,
+                 timeout: float,
+                 now: Callable[[], datetime] = datetime.now,
+                 name: str = "executor",
+                 max_pending: Optional[int] = None,
+                 submit_timeout: Optional[float] = None):
+        self.logger = logger
+        self.timeout = timeout
+        # Submitting blocks for at most submit_timeout seconds while max_pending tasks
+        # are queued or running, after which QueueFullError is raised
+        self.pending = BoundedSemaphore(max_pending) if max_pending else None
+        self.submit_timeout = submit_timeout
+        self.rejected = 0
+        self.now = now
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self.lock = Lock()
+        # The last submitted task for every device, later tasks for the same device wait for it
+        self.last_futures: dict[str, Future] = {}
+        self.queued = 0
+        self.running = 0
+        self.overruns = 0
+        self.lateness = deque(maxlen=self.LATENESS_SAMPLES)
+
+    # Runs the function on the pool. Tasks sharing a key run one at a time, in the
+    # order they were submitted, while tasks for other devices run in parallel.
+    def submit(self,
+               function: Callable,
+               keys: Iterable[str] = (),
+               planned: Optional[datetime] = None,
+               description: str = "") -> Future:
+        if self.pending and not self.pending.acquire(timeout=self.submit_timeout):
+            with self.lock:
+                self.rejected += 1
+            raise QueueFullError("Too many pending tasks, rejected {}".format(description))
+
+        with self.lock:
+            keys = set(keys)
+            previous = {self.last_futures[key] for key in keys if key in self.last_futures}
+            future = self.pool.submit(self.run, function, previous, planned, description)
+            for key in keys:
+                self.last_futures[key] = future
+            self.queued += 1
+        future.add_done_callback(lambda future: self.forget(keys, future))
+        return future
+
+    def forget(self, keys: set, future: Future):
+        with self.lock:
+            for key in keys:
+                if self.last_futures.get(key) is future:
+                    del self.last_futures[key]
+        if self.pending:
+            self.pending.release()
+
+    def run(self, function: Callable, previous: set, planned: Optional[datetime], description: str):
+        # Tasks are started in the order they were submitted, so the previous
+        # tasks for the same devices are already running or done
+        _, not_done = wait(previous, timeout=self.timeout)
+        if not_done:
+            self.logger.error("Gave up waiting for {} earlier tasks before {}".format(len(not_done), description))
+
+        with self.lock:
+            self.queued -= 1
+            self.running += 1
+        if planned is not None:
+            self.lateness.append((self.now() - planned).total_seconds())
+
+        start = time.monotonic()
+        try:
+            return function()
+        except Exception:
+            self.logger.exception("Executing {} failed".format(description))
+            raise
+        finally:
+            duration = time.monotonic() - start
+            with self.lock:
+                self.running -= 1
+                if duration > self.timeout:
+                    self.overruns += 1
+            if duration > self.timeout:
+                self.logger.error("Executing {} took {:.1f} s".format(description, duration))
+
+    def export_metrics(self) -> dict:
+        lateness = list(self.lateness)
+        return {
+            "queued": self.queued,
+            "running": self.running,
+            "overruns": self.overruns,
+            "rejected": self.rejected,
+            "lateness": {
+                "last": lateness[-1] if lateness else None,
+                "max": max(lateness, default=None),
+                "average": sum(lateness) / len(lateness) if lateness else None
+            }
+        }
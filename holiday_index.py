@@ -0,0 +1,31 @@
+from datetime import date
+from threading import Lock
+from typing import List, Optional
+import holidays
+
+class HolidayIndex:
+    def __init__(self, country: str):
+        self.country = country
+        self.lock = Lock()
+        # Year -> (date -> name, unique names in date order)
+        self.years: dict[int, tuple[dict[date, str], List[str]]] = {}
+
+    def load_year(self, year: int) -> tuple[dict[date, str], List[str]]:
+        if year not in self.years:
+            with self.lock:
+                if year not in self.years:
+                    by_date = dict(sorted(holidays.country_holidays(self.country, years=year).items()))
+                    names = list(dict.fromkeys(by_date.values()))
+                    self.years[year] = (by_date, names)
+        return self.years[year]
+
+    def get(self, day: date) -> Optional[str]:
+        by_date, _ = self.load_year(day.year)
+        return by_date.get(day)
+
+    def __contains__(self, day: date) -> bool:
+        return self.get(day) is not None
+
+    def names(self, year: int = None) -> List[str]:
+        _, names = self.load_year(year or date.today().year)
+        return names
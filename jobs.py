@@ -0,0 +1,55 @@
+import copy
+from collections import OrderedDict
+from datetime import datetime
+from threading import Lock
+from typing import Optional
+import uuid
+
+# Number of finished and pending jobs to remember, the oldest are forgotten first
+MAX_JOBS = 100
+
+class JobTable:
+    def __init__(self, max_jobs: int = MAX_JOBS):
+        self.max_jobs = max_jobs
+        self.lock = Lock()
+        self.jobs: OrderedDict[str, dict] = OrderedDict()
+
+    def create(self, kind: str, name: str) -> str:
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.jobs[job_id] = {
+                "id": job_id,
+                kind: name,
+                "status": "queued",
+                "submitted": datetime.now().isoformat(timespec="milliseconds"),
+                "started": None,
+                "finished": None,
+                "parts": []
+            }
+            while len(self.jobs) > self.max_jobs:
+                self.jobs.popitem(last=False)
+        return job_id
+
+    def update(self, job_id: str, **values):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id].update(values)
+
+    def start(self, job_id: str):
+        self.update(job_id, status="running", started=datetime.now().isoformat(timespec="milliseconds"))
+
+    def finish(self, job_id: str, status: str, **values):
+        self.update(job_id, status=status, finished=datetime.now().isoformat(timespec="milliseconds"), **values)
+
+    def add_part(self, job_id: str, part: dict):
+        with self.lock:
+            if job_id in self.jobs:
+                self.jobs[job_id]["parts"].append(part)
+
+    def remove(self, job_id: str):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self.lock:
+            return copy.deepcopy(self.jobs.get(job_id))
@@ -0,0 +1,98 @@
+import socket
+from typing import List
+
+# Where lircd listens for commands
+SOCKET_PATH = "/var/run/lirc/lircd"
+# Seconds to wait for lircd to answer
+TIMEOUT = 5
+
+class LircdError(Exception):
+    pass
+
+class LircdClient:
+    def __init__(self, path: str = SOCKET_PATH, timeout: float = TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+        self.connection = None
+        self.buffer = b""
+        self.reconnects = 0
+
+    def connect(self):
+        self.close()
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.settimeout(self.timeout)
+        connection.connect(self.path)
+        self.connection = connection
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except OSError:
+                pass
+        self.connection = None
+        self.buffer = b""
+
+    def send_once(self, remote: str, key: str, repeat: int = 0):
+        if repeat:
+            self.command("SEND_ONCE {} {} {}".format(remote, key, repeat))
+        else:
+            self.command("SEND_ONCE {} {}".format(remote, key))
+
+    # Sends a command over the connection, which is kept open between commands.
+    # If lircd was restarted since the last command, reconnects and tries once more.
+    def command(self, command: str) -> List[str]:
+        for attempt in range(2):
+            reused = self.connection is not None
+            if not reused:
+                self.connect()
+                if attempt:
+                    self.reconnects += 1
+            try:
+                self.connection.sendall((command + "\n").encode("utf-8"))
+            except ConnectionError:
+                # lircd closed the connection since the last command, so nothing was sent
+                self.close()
+                if reused:
+                    continue
+                raise
+            except OSError:
+                self.close()
+                raise
+
+            try:
+                return self.read_reply(command)
+            except OSError:
+                # lircd may already have sent the command, so do not send it again
+                self.close()
+                raise
+
+    def read_line(self) -> str:
+        while b"\n" not in self.buffer:
+            data = self.connection.recv(4096)
+            if not data:
+                raise ConnectionResetError("lircd closed the connection")
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode("utf-8").strip()
+
+    # A reply is BEGIN, the command, SUCCESS or ERROR, optionally DATA, the
+    # number of lines and the lines, and END. Broadcasts such as SIGHUP and
+    # replies to other commands are skipped.
+    def read_reply(self, command: str) -> List[str]:
+        while True:
+            if self.read_line() != "BEGIN":
+                continue
+            echo = self.read_line()
+            lines = []
+            line = self.read_line()
+            while line != "END":
+                lines.append(line)
+                line = self.read_line()
+            if echo != command:
+                continue
+
+            status, data = (lines[0], lines[3:]) if lines else ("SUCCESS", [])
+            if status == "ERROR":
+                raise LircdError("{} failed: {}".format(command, " ".join(data)))
+            return data
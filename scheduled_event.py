@@ -0,0 +1,130 @@
+from datetime import date
+from enum import Enum
+from typing import List, Optional, Union
+
+ALL_DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+ALL_WEEKDAYS = (1 << len(ALL_DAYS)) - 1
+
+class TriggerMode(Enum):
+    PLAIN = None
+    ON_DARK = "onDark"
+    ON_SUNNY = "onSunny"
+    WAIT_FOR_SUNRISE = "waitForSunrise"
+    WAIT_FOR_SUNSET = "waitForSunset"
+
+class ScheduledEvent:
+    # Keys of activities.json that are parsed into attributes, all other keys are kept as they are
+    KNOWN_KEYS = {"id", "time", "days", "commands", "disabled", "disabledUntil", "fireOnce",
+                  "excludeAllHolidays", "excludedHolidays", "ifExecutedEventID", "preponeWhenCloudy",
+                  *(mode.value for mode in TriggerMode if mode.value)}
+
+    __slots__ = ("id", "time", "hour", "minute", "days", "weekdays", "commands", "disabled",
+                 "disabled_until", "fire_once", "exclude_all_holidays", "excluded_holidays",
+                 "excluded_holiday_set", "trigger", "if_executed_event_id", "prepone_when_cloudy", "extra",
+                 "key_order")
+
+    def __init__(self, data: dict):
+        self.id: str = data.get("id")
+        if not isinstance(self.id, str) or not self.id:
+            raise ValueError("The event needs an ID.")
+
+        self.time: str = data.get("time")
+        try:
+            self.hour, self.minute = [int(x) for x in self.time.split(":")]
+        except (AttributeError, ValueError):
+            raise ValueError("Invalid time of event {}: {}".format(self.id, self.time))
+        if not (0 <= self.hour <= 23 and 0 <= self.minute <= 59):
+            raise ValueError("Invalid time of event {}: {}".format(self.id, self.time))
+
+        self.days: Optional[List[str]] = data.get("days")
+        if self.days is None:
+            self.weekdays = ALL_WEEKDAYS
+        elif self.days == []:
+            raise ValueError("Event {} needs at least one day.".format(self.id))
+        elif isinstance(self.days, list) and all(day in ALL_DAYS for day in self.days):
+            self.weekdays = sum(1 << ALL_DAYS.index(day) for day in set(self.days))
+        else:
+            raise ValueError("Invalid days of event {}: {}".format(self.id, self.days))
+
+        self.commands: Optional[Union[dict, list]] = data.get("commands")
+        if self.commands is not None and not isinstance(self.commands, (dict, list)):
+            raise ValueError("Invalid commands of event {}.".format(self.id))
+
+        # None means that the key is not set at all
+        self.disabled: Optional[bool] = data.get("disabled")
+        self.fire_once: Optional[bool] = data.get("fireOnce")
+        self.exclude_all_holidays: Optional[bool] = data.get("excludeAllHolidays")
+
+        self.disabled_until: Optional[date] = None
+        if data.get("disabledUntil"):
+            try:
+                self.disabled_until = date.fromisoformat(data["disabledUntil"])
+            except (TypeError, ValueError):
+                raise ValueError("Invalid date of event {}: {}".format(self.id, data["disabledUntil"]))
+
+        self.excluded_holidays: Optional[List[str]] = data.get("excludedHolidays")
+        if self.excluded_holidays is not None and not isinstance(self.excluded_holidays, list):
+            raise ValueError("Invalid excluded holidays of event {}.".format(self.id))
+        self.excluded_holiday_set = frozenset(self.excluded_holidays or [])
+
+        modes = [mode for mode in TriggerMode if mode.value and mode.value in data]
+        if len(modes) > 1:
+            raise ValueError("Event {} can only have one of {}.".format(self.id, [mode.value for mode in modes]))
+        self.trigger = modes[0] if modes else TriggerMode.PLAIN
+
+        self.if_executed_event_id: Optional[str] = data.get("ifExecutedEventID")
+
+        self.prepone_when_cloudy: Optional[dict] = data.get("preponeWhenCloudy")
+        if self.prepone_when_cloudy is not None and (not isinstance(self.prepone_when_cloudy, dict) or
+            not {"minutes_offset", "threshold"} <= self.prepone_when_cloudy.keys()):
+            raise ValueError("preponeWhenCloudy of event {} needs minutes_offset and threshold.".format(self.id))
+
+        self.extra = {key: value for key, value in data.items() if key not in self.KNOWN_KEYS}
+        # Write the keys back in the same order as they were read
+        self.key_order = tuple(data)
+
+    def runs_on(self, weekday: int) -> bool:
+        return bool(self.weekdays & (1 << weekday))
+
+    def is_disabled(self, today: date) -> bool:
+        return bool(self.disabled) or (self.disabled_until is not None and self.disabled_until >= today)
+
+    def is_excluded(self, holiday: Optional[str]) -> bool:
+        if holiday is None:
+            return False
+        return bool(self.exclude_all_holidays) or holiday in self.excluded_holiday_set
+
+    # Names of the devices the commands of this event control
+    def device_keys(self) -> List[str]:
+        if not isinstance(self.commands, dict):
+            return []
+        keys = ["tradfri:{}".format(group_id) for group_id in self.commands.get("tradfri", {})]
+        keys += ["activity:{}/{}".format(group, name) for name, group in self.commands.get("plain", [])]
+        return keys
+
+    def to_dict(self) -> dict:
+        data = {"id": self.id, "time": self.time}
+        if self.trigger != TriggerMode.PLAIN:
+            data[self.trigger.value] = True
+        if self.if_executed_event_id is not None:
+            data["ifExecutedEventID"] = self.if_executed_event_id
+        if self.days is not None:
+            data["days"] = self.days
+        if self.disabled is not None:
+            data["disabled"] = self.disabled
+        if self.disabled_until is not None:
+            data["disabledUntil"] = self.disabled_until.isoformat()
+        if self.fire_once is not None:
+            data["fireOnce"] = self.fire_once
+        if self.commands is not None:
+            data["commands"] = self.commands
+        if self.exclude_all_holidays is not None:
+            data["excludeAllHolidays"] = self.exclude_all_holidays
+        if self.excluded_holidays is not None:
+            data["excludedHolidays"] = self.excluded_holidays
+        if self.prepone_when_cloudy is not None:
+            data["preponeWhenCloudy"] = self.prepone_when_cloudy
+        data.update(self.extra)
+        ordered = {key: data[key] for key in self.key_order if key in data}
+        ordered.update(data)
+        return ordered
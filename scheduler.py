@@ -1,167 +1,245 @@
 from logging import Logger
-from typing import Callable, Iterable
+from typing import Callable, List, Optional
+import heapq
+import itertools
 import pytz
-import schedule
-from datetime import datetime, date, timedelta
-from astral.geocoder import lookup, database
-from astral.location import Location
-from time import sleep
+from datetime import datetime, time, timedelta
 import threading
-import util
+from sun_times import SunTimes
+from holiday_index import HolidayIndex
+from scheduled_event import ScheduledEvent, TriggerMode
+from executor import OrderedExecutor
+
+# Number of events that can be executed at the same time
+MAX_CONCURRENT_EVENTS = 4
+# Events running longer than this are reported, and later events for the same devices stop waiting for them
+EVENT_TIMEOUT_SECONDS = 60
+# Longest single wait for the next entry, so that a jump of the clock is noticed soon
+MAX_WAIT_SECONDS = 60
+# Entries that are due for longer than this, for example after the clock jumped
+# forward or the system was suspended, are skipped instead of run
+MAX_LATENESS_SECONDS = 5 * 60
 
 class Scheduler:
     def __init__(self,
                  logger: Logger,
-                 execute_callback: Callable[[dict], None],
+                 execute_callback: Callable[[ScheduledEvent], None],
                  cloud_check: Callable[[int], bool],
-                 scheduled_events: dict,
+                 scheduled_events: List[ScheduledEvent],
                  timezone: pytz.timezone,
-                 all_holidays: Iterable):
+                 all_holidays: HolidayIndex,
+                 sun_times: SunTimes = None,
+                 now: Callable[[], datetime] = None):
         self.logger = logger
         self.execute_callback = execute_callback
         self.cloud_check = cloud_check
         self.scheduled_events = scheduled_events
         self.timezone = timezone
         self.all_holidays = all_holidays
+        self.sun_times = sun_times or SunTimes(timezone)
+        self.now = now or (lambda: datetime.now(self.timezone))
+        self.executor = OrderedExecutor(logger, MAX_CONCURRENT_EVENTS, EVENT_TIMEOUT_SECONDS,
+                                        now=self.now, name="scheduler")
         self.executed_scheduled_events = {}
+        self.executed_date = None
+
+        self.condition = threading.Condition()
+        # Heap of (fire time, sequence number, function, keyword arguments)
+        self.queue = []
+        self.sequence = itertools.count()
+        self.needs_reload = True
 
     def start(self):
         self.thread = threading.Thread(target=self.run_schedule, args=())
         self.thread.daemon = True
         self.thread.start()
 
-    def run_schedule(self):
-        all_days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+    # Recomputes the fire times of all events, for example after they were edited
+    def reload(self):
+        with self.condition:
+            self.needs_reload = True
+            self.condition.notify()
 
-        def is_valid_time_and_day() -> bool:
-            # If today is a holiday and all holidays should be excluded
-            if "excludeAllHolidays" in event and event["excludeAllHolidays"] and now.date() in self.all_holidays:
-                return False
-
-            if "excludedHolidays" in event:
-                # If today is a holiday and this holiday should be excluded
-                if now.date() in self.all_holidays and dict(self.all_holidays.items())[now.date()] in event["excludedHolidays"]:
-                    return False
+    def run_schedule(self):
+        while True:
+            timeout = self.run_pending()
+            with self.condition:
+                if not self.needs_reload:
+                    self.condition.wait(MAX_WAIT_SECONDS if timeout is None else min(timeout, MAX_WAIT_SECONDS))
+
+    # Runs everything that is due and returns the number of seconds until
+    # the next entry is due, or None if nothing is scheduled
+    def run_pending(self) -> Optional[float]:
+        now = self.now()
+        with self.condition:
+            if self.needs_reload:
+                self.needs_reload = False
+                self.rebuild_queue(now)
+
+        # Reset data structures keeping track of which events have run
+        if self.executed_date != now.date():
+            self.executed_date = now.date()
+            self.executed_scheduled_events.clear()
 
-            return now.hour == hour and now.minute == minute and \
-                ("days" not in event or currentDay in event["days"])
+        while True:
+            with self.condition:
+                if not self.queue or self.queue[0][0] > now:
+                    break
+                fire_time, _, function, kwargs = heapq.heappop(self.queue)
+            if (now - fire_time).total_seconds() > MAX_LATENESS_SECONDS:
+                self.logger.warning("Skipping {} of event {} planned for {}, it is {} late"
+                                    .format(function.__name__, kwargs["event"].id,
+                                            fire_time.strftime("%Y-%m-%d %H:%M"), now - fire_time))
+                if function == self.fire_event:
+                    self.schedule_next(kwargs["event"], now)
+                continue
+            function(planned=fire_time, **kwargs)
+
+        with self.condition:
+            if not self.queue:
+                return None
+            return max(0, (self.queue[0][0] - self.now()).total_seconds())
+
+    def push(self, fire_time: datetime, function: Callable, **kwargs):
+        with self.condition:
+            heapq.heappush(self.queue, (fire_time, next(self.sequence), function, kwargs))
+            self.condition.notify()
+
+    def rebuild_queue(self, now: datetime):
+        # Keep the one-off entries such as rescheduled events and cloud checks,
+        # unless their event was edited, deleted or disabled since
+        self.queue = [entry for entry in self.queue
+                      if entry[2] != self.fire_event and self.is_current(entry[3]["event"], now)]
+        for event in self.scheduled_events:
+            fire_time = self.next_fire_time(event, now)
+            if fire_time is not None:
+                self.queue.append((fire_time, next(self.sequence), self.fire_event, {"event": event}))
+        heapq.heapify(self.queue)
+
+    # Edited events are replaced by a new ScheduledEvent, so an edited event is no longer current
+    def is_current(self, event: ScheduledEvent, now: datetime) -> bool:
+        return event in self.scheduled_events and not event.is_disabled(now.date())
+
+    # The first time after `after` that matches the time and days of the event,
+    # or None if the event does not run on any day
+    def next_fire_time(self, event: ScheduledEvent, after: datetime) -> Optional[datetime]:
+        day = after.astimezone(self.timezone).date()
+        # Today and the next seven days cover every weekday at a time after `after`
+        for _ in range(8):
+            fire_time = self.localize(datetime.combine(day, time(event.hour, event.minute)))
+            if fire_time > after and event.runs_on(day.weekday()):
+                return fire_time
+            day += timedelta(days=1)
+        return None
+
+    def localize(self, naive: datetime) -> datetime:
+        try:
+            return self.timezone.localize(naive, is_dst=None)
+        except pytz.AmbiguousTimeError:
+            # The clock is turned back, fire at the first occurrence
+            return self.timezone.localize(naive, is_dst=True)
+        except pytz.NonExistentTimeError:
+            # The clock is turned forward past this time, fire right after the jump
+            return self.timezone.normalize(self.timezone.localize(naive, is_dst=False))
+
+    def schedule_next(self, event: ScheduledEvent, now: datetime):
+        fire_time = self.next_fire_time(event, now)
+        if fire_time is not None:
+            self.push(fire_time, self.fire_event, event=event)
+
+    def fire_event(self, planned: datetime, event: ScheduledEvent):
+        now = self.now()
+        if event in self.scheduled_events:
+            self.schedule_next(event, now)
+        else:
+            # The event was deleted
+            return
 
         def reschedule_event():
-            time_str = (now + time_until).strftime("%H:%M")
-            self.logger.info("Reschedule for {}".format(time_str))
-            schedule.every().day.at(time_str).do(self.execute_once, event=event)
+            self.logger.info("Reschedule for {}".format((now + time_until).strftime("%H:%M")))
+            self.push(now + time_until, self.execute_once, event=event)
 
         def run_scheduled_event():
-            self.executed_scheduled_events[event['id']] = True
-            self.logger.info("Executing scheduled event {}".format(event['id']))
-            self.execute_callback(event)
+            self.executed_scheduled_events[event.id] = True
+            self.logger.info("Executing scheduled event {}".format(event.id))
+            self.execute(event, planned)
 
         def try_reschedule_for_cloud_check() -> bool:
-            if "preponeWhenCloudy" not in event:
+            if event.prepone_when_cloudy is None:
                 return False
 
-            cloudy_settings = event["preponeWhenCloudy"]
+            cloudy_settings = event.prepone_when_cloudy
             cloudy_offset = timedelta(minutes=cloudy_settings["minutes_offset"])
             cloudy_threshold = cloudy_settings["threshold"]
 
-            time_str = max(now, now + time_until - cloudy_offset).strftime("%H:%M")
-            self.logger.info("Schedule cloud check for {}".format(time_str))
-            schedule.every().day.at(time_str).do(self.execute_cloud_check_once,
-                                                 event=event, cloudy_offset=cloudy_offset,
-                                                 cloudy_threshold=cloudy_threshold)
+            check_time = max(now, now + time_until - cloudy_offset)
+            self.logger.info("Schedule cloud check for {}".format(check_time.strftime("%H:%M")))
+            self.push(check_time, self.execute_cloud_check_once,
+                      event=event, cloudy_offset=cloudy_offset, cloudy_threshold=cloudy_threshold)
             return True
 
-        while True:
-            now = datetime.now(self.timezone)
-            dayIndex = datetime.today().weekday()
-            currentDay = all_days[dayIndex]
-
-            for event in self.scheduled_events:
-                hour, minute = util.get_hour_minute(event["time"])
-
-                # Is event disabled?
-                if ("disabled" in event and event["disabled"]) or ("disabledUntil" in event and
-                                            event["disabledUntil"] >= now.strftime('%Y-%m-%d')):
-                    continue
-
-                # Skip event if we already processed it or if the day and time is not matching
-                if event["id"] in self.executed_scheduled_events or not is_valid_time_and_day():
-                    continue
-
-                if "ifExecutedEventID" in event and event["ifExecutedEventID"] not in self.executed_scheduled_events:
-                    continue
-
-                if "onDark" in event:
-                    is_dark, _ = self.get_sun_info()
-                    if is_dark:
-                        run_scheduled_event()
-                elif "onSunny" in event:
-                    is_dark, _ = self.get_sun_info()
-                    if not is_dark:
-                        run_scheduled_event()
-                elif "waitForSunrise" in event:
-                    is_dark, time_until = self.get_sun_info()
-                    if not is_dark:
-                        run_scheduled_event()
-                    elif not try_reschedule_for_cloud_check():
-                        reschedule_event()
-                elif "waitForSunset" in event:
-                    is_dark, time_until = self.get_sun_info()
-                    if is_dark:
-                        run_scheduled_event()
-                    elif not try_reschedule_for_cloud_check():
-                        reschedule_event()
-                else:
-                    run_scheduled_event()
-
-            schedule.run_pending()
-
-            # Reset data structures keeping track of which events have run
-            if now.hour == 0 and now.minute == 0:
-                self.executed_scheduled_events.clear()
-            sleep(60)
-
-    # There is no other way to schedule only once other than doing this.
-    def execute_once(self, event: dict):
-        self.logger.info("Executing rescheduled event {}".format(event['id']))
-        self.execute_callback(event)
-
-        self.executed_scheduled_events[event['id']] = True
-        return schedule.CancelJob
-
-    def execute_cloud_check_once(self, event: dict, cloudy_offset: int, cloudy_threshold: int):
-        self.logger.info("Executing cloud check for event {}".format(event['id']))
-        if self.cloud_check(cloudy_threshold):
-            self.execute_callback(event)
-            self.executed_scheduled_events[event['id']] = True
+        # Is event disabled?
+        if event.is_disabled(now.date()):
+            return
+
+        # If today is a holiday and all holidays or this holiday should be excluded
+        if event.is_excluded(self.all_holidays.get(now.date())):
+            return
+
+        # Skip event if we already processed it
+        if event.id in self.executed_scheduled_events:
+            return
+
+        if event.if_executed_event_id is not None and event.if_executed_event_id not in self.executed_scheduled_events:
+            return
+
+        if event.trigger == TriggerMode.ON_DARK:
+            is_dark, _ = self.get_sun_info()
+            if is_dark:
+                run_scheduled_event()
+        elif event.trigger == TriggerMode.ON_SUNNY:
+            is_dark, _ = self.get_sun_info()
+            if not is_dark:
+                run_scheduled_event()
+        elif event.trigger == TriggerMode.WAIT_FOR_SUNRISE:
+            is_dark, time_until = self.get_sun_info()
+            if not is_dark:
+                run_scheduled_event()
+            elif not try_reschedule_for_cloud_check():
+                reschedule_event()
+        elif event.trigger == TriggerMode.WAIT_FOR_SUNSET:
+            is_dark, time_until = self.get_sun_info()
+            if is_dark:
+                run_scheduled_event()
+            elif not try_reschedule_for_cloud_check():
+                reschedule_event()
         else:
-            now = datetime.now(self.timezone)
-            time_str = (now + cloudy_offset).strftime("%H:%M")
-            schedule.every().day.at(time_str).do(self.execute_once, event=event)
+            run_scheduled_event()
+
+    def execute(self, event: ScheduledEvent, planned: datetime):
+        self.executor.submit(lambda: self.execute_callback(event), event.device_keys(), planned, event.id)
+
+    def execute_once(self, planned: datetime, event: ScheduledEvent):
+        self.logger.info("Executing rescheduled event {}".format(event.id))
+        self.execute(event, planned)
+
+        self.executed_scheduled_events[event.id] = True
 
-        return schedule.CancelJob
+    def execute_cloud_check_once(self, planned: datetime, event: ScheduledEvent,
+                                 cloudy_offset: timedelta, cloudy_threshold: int):
+        self.logger.info("Executing cloud check for event {}".format(event.id))
+        if self.cloud_check(cloudy_threshold):
+            self.execute(event, planned)
+            self.executed_scheduled_events[event.id] = True
+        else:
+            self.push(self.now() + cloudy_offset, self.execute_once, event=event)
 
     # Returns if it is dark or light, and the time until the next sunrise/sunset
     # True means it is dark, False means it is sunny
     def get_sun_info(self) -> tuple[bool, timedelta]:
-        city_name = self.timezone.zone.split('/')[1]
-        city = Location(lookup(city_name, database()))
-        today = date.today()
-        sun = city.sun(date=today, local=True)
-        current_time = datetime.now(self.timezone)
-        # Is it between sunrise and sunset?
-        if sun["sunrise"] <= current_time <= sun["sunset"]:
-            if sun["sunset"] >= current_time:
-                event = "sunset"
-                timediff = sun[event] - current_time
-            if sun["sunset"] <= current_time:
-                event = "sunrise"
-                timediff = current_time - sun[event]
-
-            self.logger.info("It's sunny outside, {} in {}".format(event, timediff))
-            return (False, timediff)
-        else:
-            sun_tomorrow = city.sun(date=today + timedelta(days=1), local=True)
-            timediff = sun_tomorrow["sunrise"] - current_time
+        is_dark, timediff = self.sun_times.get_sun_info(self.now())
+        if is_dark:
             self.logger.info("It's dark outside, {} until sunrise".format(timediff))
-            return (True, timediff)
+        else:
+            self.logger.info("It's sunny outside, sunset in {}".format(timediff))
+        return (is_dark, timediff)
@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
-import operator
 import sys
 import os
-from threading import Thread
-from time import sleep
+import signal
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Callable, List, Tuple
 from flask import *
 from http import HTTPStatus
@@ -11,15 +10,22 @@ import config
 from credentials import *
 import base64
 from collections import ChainMap
-from IKEA import TradfriHandler
+from IKEA import CommandResult, TradfriHandler, check_group_values
 from scheduler import Scheduler
+from scheduled_event import ScheduledEvent
+from sun_times import SunTimes
+from holiday_index import HolidayIndex
 from weather import WeatherManager
-from channel_handler import ChannelHandler, SonyTVAPIHandler
-import util
-
-from datetime import datetime, time
-import holidays
-from collections import OrderedDict
+from channel_handler import ChannelHandler, MHZ433Base
+from activity_registry import ActivityRegistry, BoundCode, Step
+from executor import OrderedExecutor, QueueFullError
+from webhooks import Invocation, Webhook, WebhookGate, WebhookPart, WebhookRegistry
+from jobs import JobTable
+from events import EventHub, MAX_SUBSCRIBERS
+import json
+
+from datetime import datetime
+from time import monotonic, sleep
 import pytz
 
 import logging
@@ -28,12 +34,36 @@ from logging.handlers import RotatingFileHandler
 # Create flask application.
 app = Flask(__name__)
 
+# Limits of the executor running activities
+COMMAND_WORKERS = 4
+COMMAND_TIMEOUT_SECONDS = 30
+# Callers wait at most COMMAND_SUBMIT_TIMEOUT_SECONDS when this many activities are pending
+MAX_PENDING_COMMANDS = 32
+COMMAND_SUBMIT_TIMEOUT_SECONDS = 5
+# Limits of the executor running webhooks
+WEBHOOK_WORKERS = 2
+WEBHOOK_TIMEOUT_SECONDS = 60
+MAX_PENDING_WEBHOOKS = 16
+# Seconds between comments sent to idle /events subscribers
+EVENTS_KEEPALIVE_SECONDS = 15
+# Threads sending the codes of different channels of an activity at the same time
+CHANNEL_WORKERS = 8
+
 def get_current_date_string():
     return datetime.now().strftime('%Y-%m-%dT%H:%M')
 
 def respond(http_status: HTTPStatus, content: str = None) -> Tuple[str, int]:
     return http_status.phrase if content == None else content, http_status.value
 
+def respond_tradfri(result: CommandResult) -> Tuple[str, int]:
+    if result == CommandResult.NOT_FOUND:
+        return respond(HTTPStatus.NOT_FOUND, "Device not found")
+    if result == CommandResult.FAILED:
+        return respond(HTTPStatus.GATEWAY_TIMEOUT, "Trådfri gateway did not respond")
+    if result == CommandResult.NOT_CONVERGED:
+        return respond(HTTPStatus.GATEWAY_TIMEOUT, "Command sent, but the lights did not confirm it")
+    return respond(HTTPStatus.OK)
+
 ### APP ROUTES ###
 @app.route("/")
 def root():
@@ -41,14 +71,12 @@ def root():
     if auth == None or not is_auth_ok(auth):
         return render_template("login.html")
 
-    activities = config.get_activities()
-    holiday_names = list(OrderedDict.fromkeys([name for _, name in sorted(all_holidays.items())]))
     return render_template("index.html",
-                           activities=activities,
+                           activities=config.export_activities(activities),
                            tradfri_groups=tradfri_handler.export_groups(),
                            suggested_colors=["FFA64D", "FFC47E", "F5FAF6"],
                            now=get_current_date_string,
-                           holidays=holiday_names)
+                           holidays=all_holidays.names())
 
 
 @app.route("/login", methods = ['POST'])
@@ -70,7 +98,7 @@ def login():
 def command():
     name  = request.form.get("name")
     group = request.form.get("group")
-    return activity(group, return_activity_index(name, group))
+    return activity(group, activity_registry.index_of(group, name))
 
 @app.route("/checkAuth", methods=["GET"])
 def check_auth():
@@ -89,10 +117,36 @@ def get_commands():
     # Check authorization
     if not is_auth_ok():
         return respond(HTTPStatus.UNAUTHORIZED)
-    commands = activities.copy()
+    commands = config.export_activities(activities)
     commands["tradfri_groups"] = tradfri_handler.export_groups()
     return jsonify(commands)
 
+
+@app.route("/events", methods=["GET"])
+def events():
+    # Check authorization, EventSource can only send the cookie
+    if not is_auth_ok(request.cookies.get('auth')):
+        return respond(HTTPStatus.UNAUTHORIZED)
+
+    queue = event_hub.subscribe()
+    if queue is None:
+        return respond(HTTPStatus.SERVICE_UNAVAILABLE, "Too many subscribers")
+
+    def stream():
+        try:
+            while True:
+                message = event_hub.get(queue, EVENTS_KEEPALIVE_SECONDS)
+                if message is None:
+                    # Lets the server notice when the browser has gone away
+                    yield ": keepalive\n\n"
+                    continue
+                name, data = message
+                yield "event: {}\ndata: {}\n\n".format(name, json.dumps(data))
+        finally:
+            event_hub.unsubscribe(queue)
+
+    return Response(stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 ## Scheduling
 @app.route("/schedule/run/<string:identifier>", methods=["POST"])
 def manually_run_event(identifier):
@@ -100,17 +154,39 @@ def manually_run_event(identifier):
         return respond(HTTPStatus.UNAUTHORIZED)
 
     _, event = return_schedule_index(identifier)
+    if event is None:
+        return respond(HTTPStatus.NOT_FOUND, "Event does not exist: {}".format(identifier))
+
     run_event(event)
     return respond(HTTPStatus.OK)
 
 
+@app.route("/schedule/metrics", methods=["GET"])
+def schedule_metrics():
+    if not is_auth_ok():
+        return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(scheduler.executor.export_metrics())
+
+
+@app.route("/activity/metrics", methods=["GET"])
+def activity_metrics():
+    if not is_auth_ok():
+        return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(command_executor.export_metrics())
+
+
 @app.route("/schedule/enable/<string:identifier>", methods=["POST"])
 def set_enabled(identifier):
     if not is_auth_ok():
         return respond(HTTPStatus.UNAUTHORIZED)
 
     _, event = return_schedule_index(identifier)
-    event["disabled"] = request.form.get('enabled') != "true"
+    if event is None:
+        return respond(HTTPStatus.NOT_FOUND, "Event does not exist: {}".format(identifier))
+
+    event.disabled = request.form.get('enabled') != "true"
 
     config.save_activities(activities)
     return respond(HTTPStatus.OK)
@@ -142,7 +218,7 @@ def configure_schedule(identifier: str) -> Tuple[str, int]:
     if len(groups) == 0:
         return respond(HTTPStatus.BAD_REQUEST, "You need to provide commands.")
 
-    if identifier == None and any(event["id"] == id for event in activities["scheduled"]):
+    if identifier == None and any(event.id == id for event in activities["scheduled"]):
         return respond(HTTPStatus.BAD_REQUEST, "An event with that name does already exist.")
 
     enabled = form.get('enabled')
@@ -205,20 +281,30 @@ def configure_schedule(identifier: str) -> Tuple[str, int]:
         if excluded_holidays:
             event["excludedHolidays"] = json.loads(excluded_holidays)
 
-    result = {}
     if identifier == None: # New event
+        index = len(activities["scheduled"])
         event = {}
-        fill_event()
-        activities["scheduled"].append(event)
-        result["data"] = activities["scheduled"][-1]
+    else: # Existing event
+        index, existing_event = return_schedule_index(identifier)
+        if existing_event is None:
+            return respond(HTTPStatus.NOT_FOUND, "Event does not exist: {}".format(identifier))
+        event = existing_event.to_dict()
+    fill_event()
+
+    try:
+        compiled_event = ScheduledEvent(event)
+    except ValueError as error:
+        return respond(HTTPStatus.BAD_REQUEST, str(error))
+
+    result = {"data": compiled_event.to_dict()}
+    if identifier == None:
+        activities["scheduled"].append(compiled_event)
         result["html"] = render_template("schedule-block.html.j2",
-                                         event=activities["scheduled"][-1],
-                                         index=len(activities["scheduled"]) - 1,
+                                         event=result["data"],
+                                         index=index,
                                          now=get_current_date_string)
-    else: # Existing event
-        _, event = return_schedule_index(identifier)
-        fill_event()
-        result["data"] = event
+    else:
+        activities["scheduled"][index] = compiled_event
 
     config.save_activities(activities)
     return respond(HTTPStatus.OK, jsonify(result))
@@ -229,7 +315,7 @@ def delete(identifier):
     if not is_auth_ok():
         return respond(HTTPStatus.UNAUTHORIZED)
 
-    index = return_schedule_index(identifier)
+    index, _ = return_schedule_index(identifier)
 
     if index == -1:
         return respond(HTTPStatus.NOT_FOUND, "Event does not exist: {}".format(identifier))
@@ -240,21 +326,51 @@ def delete(identifier):
     return respond(HTTPStatus.OK)
 
 
-def run_activity(group: dict, index: int):
-    for activity_group in activities["groups"]:
-        if activity_group["name"] != group:
-            continue
+# Runs the activity and returns how long it took
+def run_activity(group: str, index: int) -> dict:
+    activity = activity_registry.get(group, index)
+    if activity is None:
+        logger.error("Activity {} in group {} not found!".format(index, group))
+        return {}
+
+    start = monotonic()
+    for step in activity.steps:
+        if step.delay:
+            sleep(step.delay)
+        run_step(step)
+    return {"duration": round(monotonic() - start, 3)}
 
-        activity = activity_group["activities"][index]
-        for code_configuration in activity["codes"]:
-            channel = code_configuration["channel"]
-            if channel not in channel_handlers:
-                logger.error("Channel {} not found!".format(channel))
-                continue
+def run_step(step: Step):
+    lanes = {}
+    for code in step.codes:
+        lanes.setdefault(code.channel, []).append(code)
 
-            channel_handlers[channel].handle_code(channel, code_configuration["data"])
+    if len(lanes) <= 1:
+        run_lane(step.codes)
         return
 
+    # One channel is sent on this thread, the others on the channel pool
+    channels = list(lanes)
+    futures = [channel_pool.submit(run_lane, lanes[channel]) for channel in channels[1:]]
+    try:
+        run_lane(lanes[channels[0]])
+    finally:
+        # Wait for all channels even if one of them failed, then report the first error
+        for future in futures:
+            future.exception()
+    for future in futures:
+        future.result()
+
+def run_lane(codes: List[BoundCode]):
+    for code in codes:
+        code.handler.handle_code(code.channel, code.data)
+
+def submit_activity(group: str, index: int) -> Future:
+    name = activity_registry.get(group, index).name
+    return command_executor.submit(lambda: run_activity(group, index),
+                                   ["activity:{}/{}".format(group, name)],
+                                   description="activity {}/{}".format(group, name))
+
 
 @app.route("/activity/<group>/<int:index>", methods=["POST"])
 def activity(group, index):
@@ -265,8 +381,16 @@ def activity(group, index):
     if index == -1:
         return respond(HTTPStatus.NOT_IMPLEMENTED)
 
-    run_activity(group, index)
-    return respond(HTTPStatus.OK)
+    if activity_registry.get(group, index) is None:
+        return respond(HTTPStatus.NOT_FOUND, "No such activity: {}/{}".format(group, index))
+
+    try:
+        result = submit_activity(group, index).result()
+    except QueueFullError as error:
+        return respond(HTTPStatus.SERVICE_UNAVAILABLE, str(error))
+    except Exception as error:
+        return respond(HTTPStatus.INTERNAL_SERVER_ERROR, str(error))
+    return jsonify(result)
 
 ## Trådfri
 @app.route("/tradfri/<int:group_id>/dimmer/<int:value>", methods=["POST"])
@@ -275,9 +399,7 @@ def tradfri_dimmer(group_id, value):
     if not is_auth_ok():
        return respond(HTTPStatus.UNAUTHORIZED)
 
-    if not tradfri_handler.set_dimmer(group_id, value):
-        return respond(HTTPStatus.NOT_FOUND)
-    return respond(HTTPStatus.OK)
+    return respond_tradfri(tradfri_handler.set_dimmer(group_id, value))
 
 
 @app.route("/tradfri/<int:group_id>/color/<string:value>", methods=["POST"])
@@ -289,9 +411,7 @@ def tradfri_color(group_id, value):
     if value.startswith('#'):
         value = value.lstrip('#')
 
-    if not tradfri_handler.set_hex_color(group_id, value):
-        return respond(HTTPStatus.NOT_FOUND)
-    return respond(HTTPStatus.OK)
+    return respond_tradfri(tradfri_handler.set_hex_color(group_id, value))
 
 
 @app.route("/tradfri/<int:group_id>/<string:on_off>", methods=["POST"])
@@ -303,9 +423,74 @@ def tradfri_on_off(group_id, on_off):
     if on_off not in ("on", "off"):
         return respond(HTTPStatus.METHOD_NOT_ALLOWED, "Use the on/off endpoint")
 
-    if not tradfri_handler.set_state(group_id, on_off == "on"):
-        return respond(HTTPStatus.NOT_FOUND, "Device not found")
-    return respond(HTTPStatus.OK)
+    return respond_tradfri(tradfri_handler.set_state(group_id, on_off == "on"))
+
+
+@app.route("/tradfri/batch", methods=["POST"])
+def tradfri_batch():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    device_config = request.get_json(silent=True)
+    if not isinstance(device_config, dict) or not all(group_id.isdigit() for group_id in device_config):
+        return respond(HTTPStatus.BAD_REQUEST, "Expected an object of group IDs and their values.")
+    try:
+        for values in device_config.values():
+            check_group_values(values)
+    except ValueError as error:
+        return respond(HTTPStatus.BAD_REQUEST, str(error))
+
+    return jsonify(run_tradfri(device_config))
+
+
+@app.route("/tradfri/stats", methods=["GET"])
+def tradfri_stats():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(tradfri_handler.export_stats())
+
+
+## Sony
+@app.route("/sony/commands", methods=["GET"])
+def sony_commands():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(channel_handlers["SONY"].export_commands())
+
+
+## 433 MHz
+@app.route("/rf/stats", methods=["GET"])
+def rf_stats():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(MHZ433Base.transmitter.export_stats())
+
+
+@app.route("/rf/sockets", methods=["GET"])
+def rf_sockets():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify({channel: handler.export_sockets() for channel, handler in channel_handlers.items()
+                    if isinstance(handler, MHZ433Base)})
+
+
+## IR
+@app.route("/ir/stats", methods=["GET"])
+def ir_stats():
+    # Check authorization
+    if not is_auth_ok():
+       return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(channel_handlers["IR"].export_stats())
 
 
 ## Webhooks
@@ -315,85 +500,57 @@ def webhooks_exec(webhook_id):
     if not is_auth_ok():
         return respond(HTTPStatus.UNAUTHORIZED)
 
-    webhooks = activities["webhooks"]
-    if webhook_id not in webhooks:
+    webhook = webhook_registry.get(webhook_id)
+    if webhook is None:
         return respond(HTTPStatus.NOT_FOUND, "No such webhook configured: {}".format(webhook_id))
 
-    # Verify that we should run this now
-    def parse_operator_value(input: str) -> Tuple[Callable, int]:
-        ops = {
-            '=' : operator.eq,
-            '!=' : operator.ne,
-            '>=' : operator.ge,
-            '<=' : operator.le,
-            '>' : operator.gt,
-            '<' : operator.lt,
-        }
-        head = input.rstrip('0123456789')
-        tail = input[len(head):]
-        return ops[head], int(tail)
-
-    def exec_webhook_part(part: dict) -> bool:
-        if "conditional" in part:
-            conditional = part["conditional"]
-            if "within-time" in conditional:
-                within_time = conditional["within-time"]
-                start_hour, start_minute = util.get_hour_minute(within_time["start"])
-                end_hour, end_minute = util.get_hour_minute(within_time["end"])
-
-                now = datetime.now(pytz.timezone(config.TIMEZONE))
-                start = time(start_hour, start_minute)
-                end = time(end_hour, end_minute)
-
-                if not util.time_in_range(start, end, now.time()):
-                    return False # Condition was not met
-
-            if "within-months" in conditional:
-                within_months = conditional["within-months"]
-                start = within_months["start"]
-                end = within_months["end"]
-                now = datetime.now(pytz.timezone(config.TIMEZONE))
-                current_month = now.month
-                if start > end: # for example start: 8, end: 4
-                    if not (current_month >= start or current_month <= end):
-                        return False
-                elif not (start <= current_month <= end): # for example start: 1, end: 4
-                    return False
-
-            if "tradfri" in conditional:
-                for device, conditions in conditional["tradfri"].items():
-                    has_updated = False
-                    if "light-state" in conditions:
-                        light_state_cond = conditions["light-state"]
-                        has_updated = True
-                        if tradfri_handler.get_state(int(device)) != light_state_cond:
-                            return False # Condition was not met
-
-                    if "dimmer" in conditions:
-                        current_value = tradfri_handler.get_dimmer(int(device), not has_updated)
-                        op, cond_value = parse_operator_value(conditions["dimmer"])
-                        if not op(current_value, cond_value):
-                            return False # Condition was not met
-
-            if "sony-bravia-tv" in conditional and "is-on" in conditional["sony-bravia-tv"]:
-                required = conditional["sony-bravia-tv"]["is-on"]
-                if "delay" in conditional["sony-bravia-tv"]:
-                    # Since the TV takes some time to update its API, let's sleep for some time
-                    sleep(conditional["sony-bravia-tv"]["delay"] / 1000)
-                is_on = SonyTVAPIHandler.is_on()
-                if required != is_on:
-                    return False
-
-        # If we got here, all conditions were met
-        run_plain_and_tradfri(part["actions"])
-        return True
-
-    webhook = webhooks[webhook_id]
-    for part in webhook:
-        exec_webhook_part(part)
+    try:
+        outcome, job_id, future = webhook_gate.invoke(webhook)
+    except QueueFullError as error:
+        return respond(HTTPStatus.SERVICE_UNAVAILABLE, str(error))
+
+    if outcome == WebhookGate.SUPPRESSED:
+        return jsonify({"result": outcome})
+    if outcome == WebhookGate.DEFERRED:
+        return jsonify({"result": outcome}), HTTPStatus.ACCEPTED
+
+    # With ?async the webhook runs in the background and its progress is reported at /jobs/<id>
+    if "async" in request.args:
+        return jsonify({"result": outcome, "id": job_id,
+                        "url": url_for("job_status", job_id=job_id)}), HTTPStatus.ACCEPTED
+
+    try:
+        report = future.result()
+    except Exception as error:
+        return respond(HTTPStatus.INTERNAL_SERVER_ERROR, str(error))
+
+    # With ?debug the outcome and evaluation time of every condition is returned
+    if "debug" in request.args:
+        return jsonify(report)
     return respond(HTTPStatus.OK)
 
 
+@app.route("/webhook/stats", methods=["GET"])
+def webhook_stats():
+    # Check authorization
+    if not is_auth_ok():
+        return respond(HTTPStatus.UNAUTHORIZED)
+
+    return jsonify(webhook_gate.export_stats())
+
+
+@app.route("/jobs/<string:job_id>", methods=["GET"])
+def job_status(job_id):
+    # Check authorization
+    if not is_auth_ok():
+        return respond(HTTPStatus.UNAUTHORIZED)
+
+    job = jobs.get(job_id)
+    if job is None:
+        return respond(HTTPStatus.NOT_FOUND, "No such job: {}".format(job_id))
+    return jsonify(job)
+
+
 ### METHODS ###
 def is_auth_ok(auth: str = None) -> bool:
     if "FLASK_ENV" in os.environ and os.environ["FLASK_ENV"] == "development":
@@ -411,68 +568,114 @@ def is_auth_ok(auth: str = None) -> bool:
     user, pw = base64.b64decode(auth).decode('utf-8').split(":")
     return user == USERNAME and pw == PASSWORD
 
-def run_plain(commands: List):
+def run_plain(commands: List) -> dict[str, Future]:
+    futures = {}
     for data, group in commands:
-        index = return_activity_index(data, group)
-        if index != -1:
-            thread = Thread(target=run_activity, args=(group, index))
-            thread.start()
-            yield thread
-
-def run_tradfri(device_config: dict):
-    for device_id_str in device_config:
-        device_commands = device_config[device_id_str]
-        device_id = int(device_id_str)
-        if "light-state" in device_commands:
-            tradfri_handler.set_state(device_id, device_commands["light-state"])
-        if "color" in device_commands:
-            tradfri_handler.set_hex_color(device_id, device_commands["color"])
-        if "dimmer" in device_commands:
-            tradfri_handler.set_dimmer(device_id, int(device_commands["dimmer"]))
-
-def run_plain_and_tradfri(container: dict):
-    threads = None
+        index = activity_registry.index_of(group, data)
+        if index == -1:
+            logger.error("Activity {} in group {} not found!".format(data, group))
+            continue
+        try:
+            futures["{}/{}".format(group, data)] = submit_activity(group, index)
+        except QueueFullError as error:
+            logger.error(str(error))
+            failed = Future()
+            failed.set_exception(error)
+            futures["{}/{}".format(group, data)] = failed
+    return futures
+
+def run_tradfri(device_config: dict) -> dict[int, dict]:
+    return tradfri_handler.apply_batch(device_config)
+
+def run_plain_and_tradfri(container: dict) -> dict:
+    results = {}
+    futures = {}
     if "plain" in container:
-        threads = run_plain(container["plain"])
+        futures = run_plain(container["plain"])
 
     if "tradfri" in container:
-        run_tradfri(container["tradfri"])
-
-    if threads:
-        for thread in threads:
-            thread.join()
+        results["tradfri"] = run_tradfri(container["tradfri"])
+
+    if futures:
+        results["plain"] = {}
+        for name, future in futures.items():
+            try:
+                results["plain"][name] = {"result": "ok", **future.result()}
+            except Exception as error:
+                results["plain"][name] = {"result": "failed", "error": str(error)}
+    return results
+
+# Runs the parts of a webhook and returns what happened in each part.
+# on_part is called with the report of each part as soon as it is done.
+def run_webhook(webhook: List[WebhookPart], on_part: Callable[[dict], None] = None) -> List[dict]:
+    invocation = Invocation(tradfri_handler, channel_handlers["SONY"].power_monitor, timezone)
+    report = []
+    for part in webhook:
+        start = monotonic()
+        # Verify that we should run this now
+        timings = []
+        matched = part.matches(invocation, timings)
+        report.append({
+            "matched": matched,
+            "predicates": timings,
+            "actions": run_plain_and_tradfri(part.actions) if matched else None,
+            "seconds": round(monotonic() - start, 3)
+        })
+        if on_part:
+            on_part(report[-1])
+    return report
+
+# Queues the webhook and returns the ID of its job and a future of its report
+def start_webhook_job(webhook: Webhook) -> Tuple[str, Future]:
+    job_id = jobs.create("webhook", webhook.id)
+    try:
+        future = webhook_executor.submit(lambda: run_webhook_job(job_id, webhook.parts),
+                                         ["webhook:{}".format(webhook.id)],
+                                         description="webhook {}".format(webhook.id))
+    except QueueFullError:
+        jobs.remove(job_id)
+        raise
+    return job_id, future
+
+def run_webhook_job(job_id: str, webhook: List[WebhookPart]) -> List[dict]:
+    jobs.start(job_id)
+    try:
+        report = run_webhook(webhook, lambda part: jobs.add_part(job_id, part))
+    except Exception as error:
+        jobs.finish(job_id, "failed", error=str(error))
+        raise
+    jobs.finish(job_id, "done")
+    return report
+
+# The state shown by the web UI, sent to it by /events. Only cached values
+# are used, so the gateway and the TV are never asked for the state here.
+def snapshot_state() -> dict:
+    state = {}
+    for group_id, exported in tradfri_handler.get_export_snapshot().items():
+        state["tradfri/{}".format(group_id)] = {key: exported[key] for key in ("state", "dimmer", "color")}
+    today = datetime.now(timezone).date()
+    for event in activities["scheduled"]:
+        state["schedule/{}".format(event.id)] = {"enabled": not event.is_disabled(today)}
+    state["sony"] = {"on": channel_handlers["SONY"].power_monitor.is_on}
+    return state
 
-def run_event(event: dict):
-    if "commands" in event:
-        run_plain_and_tradfri(event["commands"])
+def run_event(event: ScheduledEvent):
+    if isinstance(event.commands, dict):
+        run_plain_and_tradfri(event.commands)
 
-    if "fireOnce" in event and event["fireOnce"]:
-        event["disabled"] = True
+    if event.fire_once:
+        event.disabled = True
         config.save_activities(activities)
 
 
-def return_schedule_index(identifier: str) -> Tuple[int, dict]:
+def return_schedule_index(identifier: str) -> Tuple[int, ScheduledEvent]:
     count = 0
     for event in activities["scheduled"]:
-        if event["id"] == identifier:
+        if event.id == identifier:
             return count, event
         count += 1
     return -1, None
 
-def return_activity_index(command: str, group: str) -> int:
-    count = 0
-    for activity in activities["groups"]:
-        g = activity["name"]
-        if g != group:
-            continue
-        for act in activity["activities"]:
-            n = act["name"]
-            if n == command:
-                return count
-            count += 1
-    return -1
-
-
 def init_logger() -> logging.Logger:
     log_level = logging.INFO
     log_filename = 'log.txt'
@@ -502,26 +705,56 @@ def init_logger() -> logging.Logger:
 
 
 if __name__ == "__main__":
-    # Since the holiday object cannot be created with a years parameter if the CountryHoliday is used,
-    # we have to do a simple check just to populate the years property. The other solution would be to
-    # use the language constructor, for example .SE(years=yyyy)
-    all_holidays = holidays.CountryHoliday(config.HOLIDAY_COUNTRY)
-    datetime.now() in all_holidays
-
-    activities = config.get_activities() # Parse activity configuration
+    all_holidays = HolidayIndex(config.HOLIDAY_COUNTRY)
+    timezone = pytz.timezone(config.TIMEZONE)
 
     # Setup logging to file
     logger = init_logger()
 
+    activities = config.get_activities(logger) # Parse activity configuration
+
+    channel_handlers: dict[str, ChannelHandler] = dict(ChainMap(*map(lambda listener: dict([(channel, listener) for channel in listener.channels]),
+                                                                     [clazz(logger=logger) for clazz in ChannelHandler.concrete_subclasses()])))
+
+    command_executor = OrderedExecutor(logger, COMMAND_WORKERS, COMMAND_TIMEOUT_SECONDS, name="commands",
+                                       max_pending=MAX_PENDING_COMMANDS,
+                                       submit_timeout=COMMAND_SUBMIT_TIMEOUT_SECONDS)
+    channel_pool = ThreadPoolExecutor(max_workers=CHANNEL_WORKERS, thread_name_prefix="channel")
+    activity_registry = ActivityRegistry(channel_handlers, logger)
+    activity_registry.load(activities)
+    config.add_save_listener(activity_registry.load)
+
     tradfri_handler = TradfriHandler(IKEA_GATEWAY_IP, IKEA_GATEWAY_KEY, logger)
+    tradfri_handler.start_refresher()
+    tradfri_handler.start_observing()
+    webhook_registry = WebhookRegistry(logger)
+    webhook_executor = OrderedExecutor(logger, WEBHOOK_WORKERS, WEBHOOK_TIMEOUT_SECONDS, name="webhooks",
+                                       max_pending=MAX_PENDING_WEBHOOKS, submit_timeout=0)
+    jobs = JobTable()
+    webhook_gate = WebhookGate(logger, start_webhook_job)
+    webhook_registry.load(activities)
+    config.add_save_listener(webhook_registry.load)
     weather_manager = WeatherManager(OPEN_WEATHER_MAP_KEY, OPEN_WEATHER_MAP_LAT, OPEN_WEATHER_MAP_LON)
     scheduler = Scheduler(logger, lambda event: run_event(event),
                           lambda threshold: weather_manager.is_cloudy(threshold),
-                          activities["scheduled"], pytz.timezone(config.TIMEZONE), all_holidays)
+                          activities["scheduled"], timezone, all_holidays,
+                          SunTimes(timezone, config.LATITUDE, config.LONGITUDE))
     scheduler.start()
+    # Recompute when the events fire when they are edited
+    config.add_save_listener(lambda _: scheduler.reload())
 
-    channel_handlers: dict[str, ChannelHandler] = dict(ChainMap(*map(lambda listener: dict([(channel, listener) for channel in listener.channels]),
-                                                                     [clazz(logger=logger) for clazz in ChannelHandler.__subclasses__()])))
+    channel_handlers["SONY"].power_monitor.start()
+
+    event_hub = EventHub(logger, snapshot_state)
+    event_hub.start()
+    config.add_save_listener(lambda _: event_hub.notify())
+
+    # Waitress only stops on SystemExit and KeyboardInterrupt, so without this a
+    # SIGTERM from systemctl stop would lose the changes that are not written yet
+    def terminate(*_):
+        config.flush_activities()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, terminate)
 
     logger.info("Server started")
 
@@ -529,5 +762,7 @@ if __name__ == "__main__":
     # Most common browsers send 6 requests at once. We don't really care
     # that much since we're waiting for the response from the tradfri
     # gateway either way, but increasing the number of threads to 6 gets
-    # rid of some warning logs about waiting requests.
-    serve(app, host="0.0.0.0", port=3000, threads=6)
+    # rid of some warning logs about waiting requests. Every /events
+    # subscriber holds a thread of its own on top of that.
+    serve(app, host="0.0.0.0", port=3000, threads=6 + MAX_SUBSCRIBERS)
+    config.flush_activities()
@@ -28,6 +28,25 @@ $('#tradfri-commands .hex-suggestion').on('click', e => {
   sendTradfriColor(groupID, $element.attr('value'));
 });
 
+// State pushed by the server
+onStateChange('tradfri', (groupID, group) => {
+  if (!group)
+    return;
+
+  let $container = $('#tradfri-commands .tradfri-container[group-id="' + groupID + '"]');
+  $container.find('.light-state').toggleClass('on', group.state).toggleClass('off', !group.state);
+
+  let $slider = $container.find('.slider');
+  // Do not move the slider while it is being dragged
+  if (!$slider.is(':active'))
+    $slider.val(group.dimmer);
+  // Groups without any color lights have no color
+  if (group.color)
+    $slider.css('background', 'linear-gradient(90deg, ' + group.color + '10 0%, ' + group.color + '80 100%)');
+  else
+    $slider.css('background', '');
+});
+
 
 /* Scheduling tradfri */
 
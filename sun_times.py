@@ -0,0 +1,71 @@
+from datetime import date, datetime, timedelta
+from threading import Lock
+from typing import Optional, Tuple
+import pytz
+from astral import Observer
+from astral.geocoder import lookup, database
+import astral.sun
+
+# Number of days ahead to compute sunrise and sunset for
+WINDOW_DAYS = 30
+
+class SunTimes:
+    def __init__(self, timezone: pytz.timezone, latitude: Optional[float] = None,
+                 longitude: Optional[float] = None, window_days: int = WINDOW_DAYS):
+        self.timezone = timezone
+        if latitude is None or longitude is None:
+            # Use the city in the name of the time zone, for example Europe/Stockholm
+            city = lookup(timezone.zone.split('/')[1], database())
+            latitude, longitude = city.latitude, city.longitude
+        self.observer = Observer(latitude, longitude)
+        self.window_days = window_days
+        self.lock = Lock()
+        # Date -> (sunrise, sunset). Either is None if the sun does not rise or set that day.
+        self.days: dict[date, Tuple[Optional[datetime], Optional[datetime]]] = {}
+
+    def compute_window(self, start: date):
+        days = {}
+        for offset in range(-1, self.window_days):
+            day = start + timedelta(days=offset)
+            days[day] = (self.compute(astral.sun.sunrise, day), self.compute(astral.sun.sunset, day))
+        self.days = days
+
+    def compute(self, function, day: date) -> Optional[datetime]:
+        try:
+            return function(self.observer, day, tzinfo=self.timezone)
+        except ValueError:
+            # Midnight sun or polar night
+            return None
+
+    def get_day(self, day: date) -> Tuple[Optional[datetime], Optional[datetime]]:
+        if day not in self.days:
+            with self.lock:
+                if day not in self.days:
+                    self.compute_window(day)
+        return self.days[day]
+
+    def is_sun_up_all_day(self, day: date) -> bool:
+        noon = self.timezone.localize(datetime.combine(day, datetime.min.time())) + timedelta(hours=12)
+        return astral.sun.elevation(self.observer, noon) > 0
+
+    # Returns if it is dark or light, and the time until the next sunrise/sunset
+    # True means it is dark, False means it is sunny
+    def get_sun_info(self, now: datetime) -> Tuple[bool, timedelta]:
+        today = now.astimezone(self.timezone).date()
+        sunrise, sunset = self.get_day(today)
+        if sunrise is None or sunset is None:
+            is_dark = not self.is_sun_up_all_day(today)
+            # Nothing happens today, the state lasts at least until tomorrow
+            tomorrow = self.timezone.localize(datetime.combine(today + timedelta(days=1), datetime.min.time()))
+            return (is_dark, tomorrow - now)
+
+        if now < sunrise:
+            return (True, sunrise - now)
+        if now <= sunset:
+            return (False, sunset - now)
+
+        sunrise_tomorrow, _ = self.get_day(today + timedelta(days=1))
+        if sunrise_tomorrow is None:
+            tomorrow = self.timezone.localize(datetime.combine(today + timedelta(days=1), datetime.min.time()))
+            return (True, tomorrow - now)
+        return (True, sunrise_tomorrow - now)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Use the stand-ins for the GPIO and other hardware
+os.environ.setdefault("DEBUG", "1")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
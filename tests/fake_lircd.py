@@ -0,0 +1,81 @@
+import os
+import socket
+import threading
+from typing import List
+
+# A lircd stand-in on a Unix socket. It records every command it receives and
+# answers like lircd, unless it was told to close the connection instead.
+class FakeLircd:
+    def __init__(self, path: str):
+        self.path = path
+        self.received: List[str] = []
+        self.connections = 0
+        # Whether to close the connection after reading a command, without answering
+        self.close_after_read = False
+        # Key -> error message lircd answers with
+        self.errors: dict[str, str] = {}
+        # Lines sent before every reply, for example a SIGHUP broadcast
+        self.broadcast: List[str] = []
+        self.clients: List[socket.socket] = []
+        self.start()
+
+    def start(self):
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server.bind(self.path)
+        self.server.listen()
+        threading.Thread(target=self.accept, args=(self.server,), daemon=True).start()
+
+    # Like restarting lircd, closes every connection and listens on a new socket
+    def restart(self):
+        self.stop()
+        self.start()
+
+    def stop(self):
+        self.server.close()
+        for client in self.clients:
+            # Unlike close, shutdown also ends a recv running in another thread
+            try:
+                client.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client.close()
+        self.clients = []
+        os.unlink(self.path)
+
+    def accept(self, server: socket.socket):
+        while True:
+            try:
+                client, _ = server.accept()
+            except OSError:
+                return
+            self.connections += 1
+            self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,), daemon=True).start()
+
+    def serve(self, client: socket.socket):
+        buffer = b""
+        try:
+            while True:
+                data = client.recv(4096)
+                if not data:
+                    return
+                buffer += data
+                while b"\n" in buffer:
+                    line, buffer = buffer.split(b"\n", 1)
+                    self.answer(client, line.decode("utf-8"))
+        except OSError:
+            return
+
+    def answer(self, client: socket.socket, command: str):
+        self.received.append(command)
+        if self.close_after_read:
+            client.shutdown(socket.SHUT_RDWR)
+            client.close()
+            return
+        key = command.split()[2] if len(command.split()) > 2 else ""
+        lines = list(self.broadcast)
+        if key in self.errors:
+            lines += ["BEGIN", command, "ERROR", "DATA", "1", self.errors[key], "END"]
+        else:
+            lines += ["BEGIN", command, "SUCCESS", "END"]
+        client.sendall(("\n".join(lines) + "\n").encode("utf-8"))
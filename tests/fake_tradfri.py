@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import time
+from typing import Callable, Optional
+from pytradfri.command import Command
+from pytradfri.const import (ATTR_DEVICE_STATE, ATTR_GROUP_MEMBERS, ATTR_HS_LINK, ATTR_ID,
+                             ATTR_LIGHT_COLOR_HEX, ATTR_LIGHT_CONTROL, ATTR_LIGHT_DIMMER,
+                             ATTR_NAME, ROOT_DEVICES, ROOT_GROUPS)
+from pytradfri.error import RequestTimeout
+
+LIGHT_KEYS = (ATTR_DEVICE_STATE, ATTR_LIGHT_DIMMER, ATTR_LIGHT_COLOR_HEX)
+
+# A Trådfri gateway that answers pytradfri commands from memory. Use it as the
+# api of a TradfriHandler.
+class FakeGateway:
+    def __init__(self, groups: int = 2, lights: int = 3, latency: float = 0,
+                 converge_after: Optional[int] = 1, ignore_unchanged_dimmer: bool = False):
+        self.latency = latency
+        # Number of commands to a group before its lights follow, None for never
+        self.converge_after = converge_after
+        # Like the real gateway, drop a dimmer value the group already has
+        self.ignore_unchanged_dimmer = ignore_unchanged_dimmer
+        self.lock = threading.Lock()
+        self.groups: dict[int, dict] = {}
+        self.devices: dict[int, dict] = {}
+        self.puts: dict[int, int] = {}
+        self.requests = 0
+        # Set to make every request time out
+        self.offline = False
+        # Called with the path and the new value of every group and light that changes
+        self.listeners: list[Callable[[str, dict], None]] = []
+        device_id = 65536
+        for index in range(groups):
+            group_id = 131073 + index
+            members = []
+            for _ in range(lights):
+                self.devices[device_id] = self.new_light(device_id)
+                members.append(device_id)
+                device_id += 1
+            self.groups[group_id] = {
+                ATTR_NAME: "Group {}".format(index), ATTR_ID: group_id, "9002": 0,
+                ATTR_DEVICE_STATE: 1, ATTR_LIGHT_DIMMER: 100, ATTR_LIGHT_COLOR_HEX: "f1e0b5",
+                ATTR_GROUP_MEMBERS: {ATTR_HS_LINK: {ATTR_ID: members}}, "9039": 0
+            }
+
+    @staticmethod
+    def new_light(device_id: int) -> dict:
+        return {
+            ATTR_NAME: "Light {}".format(device_id), ATTR_ID: device_id, "5750": 2, "9002": 0, "9019": 1,
+            "9054": 0, "3": {"0": "IKEA of Sweden", "1": "TRADFRI bulb", "2": "", "3": "1.0", "6": 1},
+            ATTR_LIGHT_CONTROL: [{ATTR_DEVICE_STATE: 1, ATTR_LIGHT_DIMMER: 100,
+                                  ATTR_LIGHT_COLOR_HEX: "f1e0b5", ATTR_ID: 0}]
+        }
+
+    def members(self, group_id: int) -> list[int]:
+        return self.groups[group_id][ATTR_GROUP_MEMBERS][ATTR_HS_LINK][ATTR_ID]
+
+    def light(self, device_id: int) -> dict:
+        return self.devices[device_id][ATTR_LIGHT_CONTROL][0]
+
+    # Changes a light like the IKEA remote does, without telling the group
+    def set_light(self, device_id: int, key: str, value):
+        with self.lock:
+            self.light(device_id)[key] = value
+        self.changed("{}/{}".format(ROOT_DEVICES, device_id), self.devices[device_id])
+
+    def changed(self, path: str, value: dict):
+        for listener in list(self.listeners):
+            listener(path, value)
+
+    def __call__(self, command: Command, timeout: float = None):
+        if isinstance(command, list):
+            return [self(single) for single in command]
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.requests += 1
+            if self.offline:
+                raise RequestTimeout("The fake gateway is offline")
+            if command.method == "put":
+                changes = self.put(int(command.path[-1]), command.data)
+            else:
+                return command.process_result(self.get(command.path))
+        for path, value in changes:
+            self.changed(path, value)
+        return command.process_result(None)
+
+    def get(self, path: list):
+        if path == [ROOT_GROUPS]:
+            return list(self.groups)
+        if path[0] == ROOT_GROUPS:
+            return self.groups[int(path[1])]
+        if path == [ROOT_DEVICES]:
+            return list(self.devices)
+        return self.devices[int(path[1])]
+
+    # Returns the path and value of everything that changed
+    def put(self, group_id: int, data: dict) -> list[tuple[str, dict]]:
+        group = self.groups[group_id]
+        self.puts[group_id] = self.puts.get(group_id, 0) + 1
+        converged = self.converge_after is not None and self.puts[group_id] >= self.converge_after
+        for key, value in data.items():
+            if key not in LIGHT_KEYS:
+                continue
+            if key == ATTR_LIGHT_DIMMER and self.ignore_unchanged_dimmer and group[key] == value:
+                continue
+            group[key] = value
+            if converged:
+                for device_id in self.members(group_id):
+                    self.light(device_id)[key] = value
+        changes = [("{}/{}".format(ROOT_GROUPS, group_id), group)]
+        if converged:
+            changes += [("{}/{}".format(ROOT_DEVICES, device_id), self.devices[device_id])
+                        for device_id in self.members(group_id)]
+        return changes
+
+# The same gateway as seen through pytradfri's async API. Observed groups and
+# lights are told about every change, on the event loop that observes them.
+class ObservableFakeGateway:
+    def __init__(self, gateway: FakeGateway):
+        self.gateway = gateway
+        self.lock = threading.Lock()
+        # Path -> (event loop, observe command) of the running observations
+        self.observations: dict[str, tuple[asyncio.AbstractEventLoop, Command]] = {}
+        self.observes = 0
+        gateway.listeners.append(self.notify)
+
+    async def request(self, command: Command, timeout: float = None):
+        if not command.observe:
+            return self.gateway(command, timeout)
+        if self.gateway.offline:
+            raise RequestTimeout("The fake gateway is offline")
+        with self.lock:
+            self.observes += 1
+            self.observations[command.path_str] = (asyncio.get_running_loop(), command)
+        return None
+
+    def notify(self, path: str, value: dict):
+        with self.lock:
+            observation = self.observations.get(path)
+        if observation is not None:
+            loop, command = observation
+            loop.call_soon_threadsafe(command.process_result, dict(value))
+
+    # Ends the observation of the path, like the gateway or a lost connection does
+    def end(self, path: str, error: Exception):
+        with self.lock:
+            loop, command = self.observations.pop(path)
+        loop.call_soon_threadsafe(command.err_callback, error)
+
+    # Ends every observation
+    def end_all(self, error_factory: Callable[[], Exception]):
+        with self.lock:
+            paths = list(self.observations)
+        for path in paths:
+            self.end(path, error_factory())
@@ -0,0 +1,60 @@
+import json
+import time
+import pytest
+import config
+from scheduled_event import ScheduledEvent
+
+def create_activities() -> dict:
+    return {"scheduled": [ScheduledEvent({"id": "event", "time": "07:00"})], "webhooks": {}}
+
+def read(path) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+def test_coalesces_a_burst_of_changes(tmp_path):
+    path = tmp_path / "activities.json"
+    writer = config.ActivitiesWriter(str(path), 0.2)
+    activities = create_activities()
+    for index in range(1000):
+        activities["scheduled"][0].disabled = index % 2 == 0
+        writer.mark_dirty(activities)
+    time.sleep(0.5)
+    assert writer.writes == 1
+    assert read(path)["scheduled"][0]["disabled"] is False
+
+def test_flush_writes_pending_changes(tmp_path):
+    path = tmp_path / "activities.json"
+    writer = config.ActivitiesWriter(str(path), 60)
+    writer.mark_dirty(create_activities())
+    writer.flush()
+    assert read(path)["scheduled"][0]["id"] == "event"
+    # Nothing left to write
+    writer.flush()
+    assert writer.writes == 1
+    assert [file.name for file in tmp_path.iterdir()] == ["activities.json"]
+
+def test_gives_up_when_serializing_keeps_failing(tmp_path, monkeypatch):
+    attempts = []
+
+    def export(activities):
+        attempts.append(activities)
+        raise RuntimeError("dictionary changed size during iteration")
+
+    monkeypatch.setattr(config, "export_activities", export)
+    writer = config.ActivitiesWriter(str(tmp_path / "activities.json"), 0)
+    with pytest.raises(RuntimeError):
+        writer.write(create_activities())
+    assert len(attempts) == config.MAX_EXPORT_ATTEMPTS
+
+def test_does_not_retry_a_recursion_error(tmp_path, monkeypatch):
+    attempts = []
+
+    def export(activities):
+        attempts.append(activities)
+        raise RecursionError()
+
+    monkeypatch.setattr(config, "export_activities", export)
+    writer = config.ActivitiesWriter(str(tmp_path / "activities.json"), 0)
+    with pytest.raises(RecursionError):
+        writer.write(create_activities())
+    assert len(attempts) == 1
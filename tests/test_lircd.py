@@ -0,0 +1,53 @@
+import pytest
+from fake_lircd import FakeLircd
+from lircd import LircdClient, LircdError
+
+@pytest.fixture
+def lircd(tmp_path):
+    server = FakeLircd(str(tmp_path / "lircd"))
+    yield server
+    server.stop()
+
+@pytest.fixture
+def client(lircd):
+    client = LircdClient(lircd.path, timeout=1)
+    yield client
+    client.close()
+
+def test_commands_share_one_connection(lircd, client):
+    client.send_once("TV", "KEY_1")
+    client.send_once("TV", "KEY_2", 3)
+    assert lircd.received == ["SEND_ONCE TV KEY_1", "SEND_ONCE TV KEY_2 3"]
+    assert lircd.connections == 1
+
+def test_reconnects_after_lircd_restarted(lircd, client):
+    client.send_once("TV", "KEY_1")
+    lircd.restart()
+    client.send_once("TV", "KEY_2")
+    assert lircd.received == ["SEND_ONCE TV KEY_1", "SEND_ONCE TV KEY_2"]
+    assert client.reconnects == 1
+
+def test_does_not_resend_a_received_command(lircd, client):
+    client.send_once("TV", "KEY_1")
+    lircd.close_after_read = True
+    with pytest.raises(ConnectionResetError):
+        client.send_once("TV", "KEY_POWER")
+    assert lircd.received.count("SEND_ONCE TV KEY_POWER") == 1
+
+def test_error_reply(lircd, client):
+    lircd.errors["KEY_NOPE"] = "unknown command"
+    with pytest.raises(LircdError):
+        client.send_once("TV", "KEY_NOPE")
+    # The connection is still usable
+    client.send_once("TV", "KEY_1")
+    assert lircd.connections == 1
+
+def test_skips_broadcasts(lircd, client):
+    lircd.broadcast = ["BEGIN", "SIGHUP", "END"]
+    assert client.command("SEND_ONCE TV KEY_1") == []
+
+def test_fails_when_lircd_is_not_running(lircd, client):
+    lircd.stop()
+    with pytest.raises(OSError):
+        client.send_once("TV", "KEY_1")
+    lircd.start()
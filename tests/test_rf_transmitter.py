@@ -0,0 +1,105 @@
+import logging
+import threading
+import pytest
+from channel_handler import MHZ433Base, NexaHandler, RC5Handler, RFTransmitter
+
+# Records the codes like the debug GPIO_DEVICE, and can hold the transmitter
+# busy so that codes queue up behind the one being sent
+class FakeDevice:
+    def __init__(self):
+        self.tx_repeat = 0
+        self.sent = []
+        self.busy = threading.Event()
+        self.busy.set()
+        self.error = None
+
+    def tx_code(self, code, protocol, pulse_length):
+        self.busy.wait(2)
+        if self.error is not None:
+            raise self.error
+        self.sent.append((code, protocol, pulse_length, self.tx_repeat))
+
+@pytest.fixture
+def device():
+    return FakeDevice()
+
+@pytest.fixture
+def transmitter(device):
+    return RFTransmitter(device)
+
+def send(transmitter: RFTransmitter, socket: str, code: int):
+    return transmitter.send(socket, code, 1, 350, 3, 0.1)
+
+def test_debug_device_stand_in():
+    assert MHZ433Base.GPIO_DEVICE.tx_repeat == 0
+
+def test_sends_codes_in_order(device, transmitter):
+    futures = [send(transmitter, socket, code) for socket, code in [("a", 1), ("b", 2), ("c", 3)]]
+    assert [future.result(1) for future in futures] == [1, 2, 3]
+    assert device.sent == [(1, 1, 350, 3), (2, 1, 350, 3), (3, 1, 350, 3)]
+    stats = transmitter.export_stats()
+    assert stats["sent"] == 3
+    assert stats["airtime"] == 0.3
+
+def test_last_code_of_a_socket_wins(device, transmitter):
+    device.busy.clear()
+    first = send(transmitter, "other", 9)
+    on = send(transmitter, "a", 1)
+    off = send(transmitter, "a", 2)
+    device.busy.set()
+    assert on.result(1) == off.result(1) == 2
+    first.result(1)
+    assert [sent[0] for sent in device.sent] == [9, 2]
+    assert transmitter.export_stats()["collapsed"] == 1
+
+def test_superseded_code_moves_behind_codes_queued_in_between(device, transmitter):
+    device.busy.clear()
+    send(transmitter, "other", 9)
+    send(transmitter, "a", 1)
+    everything = send(transmitter, "all", 100)
+    single = send(transmitter, "a", 1)
+    device.busy.set()
+    single.result(1)
+    everything.result(1)
+    # The socket ends up on, as requested last
+    assert [sent[0] for sent in device.sent] == [9, 100, 1]
+
+def test_errors_reach_every_caller(device, transmitter):
+    device.error = OSError("GPIO busy")
+    device.busy.clear()
+    send(transmitter, "other", 9)
+    futures = [send(transmitter, "a", 1), send(transmitter, "a", 2)]
+    device.busy.set()
+    for future in futures:
+        with pytest.raises(OSError):
+            future.result(1)
+
+@pytest.fixture
+def handlers(monkeypatch, device):
+    monkeypatch.setattr(MHZ433Base, "transmitter", RFTransmitter(device))
+    logger = logging.getLogger(__name__)
+    return RC5Handler(logger=logger), NexaHandler(logger=logger)
+
+def test_handle_code_waits_for_the_transmission(device, handlers):
+    rc5, nexa = handlers
+    rc5.handle_code("MHZ433", "ON 1")
+    nexa.handle_code("NEXA", "OFF ALL")
+    assert [sent[0] for sent in device.sent] == [1381717, nexa.get_sockets()["ALL"][1]]
+    assert device.sent[0][1:] == (RC5Handler.PROTOCOL, RC5Handler.PULSE_LENGTH, RC5Handler.REPEAT)
+
+def test_handle_code_raises_transmission_errors(device, handlers):
+    rc5, _ = handlers
+    device.error = OSError("GPIO busy")
+    with pytest.raises(OSError):
+        rc5.handle_code("MHZ433", "ON 1")
+
+def test_unknown_command(handlers):
+    rc5, _ = handlers
+    with pytest.raises(ValueError):
+        rc5.handle_code("MHZ433", "ON 99")
+
+def test_airtime(handlers):
+    rc5, nexa = handlers
+    # Pulses per code times the pulse length in microseconds
+    assert rc5.get_airtime(8) == pytest.approx(8 * (24 * 4 + 32) * 420 / 1000000)
+    assert nexa.get_airtime(3) == pytest.approx(3 * (32 * 4 + 11) * 250 / 1000000)
@@ -0,0 +1,125 @@
+import logging
+from collections import Counter
+from datetime import datetime, time, timedelta
+import pytz
+import scheduler
+from scheduled_event import ScheduledEvent
+from scheduler import Scheduler
+from sun_times import SunTimes
+
+TIMEZONE = pytz.timezone("Europe/Stockholm")
+
+class NoHolidays:
+    def get(self, day):
+        return None
+
+# Drives a scheduler with a fake clock, without waiting for real time to pass
+class Simulation:
+    def __init__(self, events: list, start: datetime):
+        self.now = start
+        self.events = events
+        self.fired = []
+        self.scheduler = Scheduler(logging.getLogger(__name__), lambda event: None, lambda threshold: False,
+                                   events, TIMEZONE, NoHolidays(), SunTimes(TIMEZONE, 59.33, 18.07),
+                                   now=lambda: self.now)
+        self.scheduler.execute = lambda event, planned: self.fired.append((event.id, self.now))
+
+    # Runs everything due until the end, advancing the clock like the
+    # scheduler's thread would sleep
+    def run_until(self, end: datetime):
+        while True:
+            timeout = self.scheduler.run_pending()
+            wait = scheduler.MAX_WAIT_SECONDS if timeout is None else min(timeout, scheduler.MAX_WAIT_SECONDS)
+            if self.now + timedelta(seconds=wait) > end:
+                self.now = end
+                self.scheduler.run_pending()
+                return
+            self.now += timedelta(seconds=wait)
+
+    def fired_times(self, event_id: str) -> list:
+        return [now for fired_id, now in self.fired if fired_id == event_id]
+
+def event(**data) -> ScheduledEvent:
+    return ScheduledEvent(dict({"commands": {}}, **data))
+
+def local(*args) -> datetime:
+    return TIMEZONE.localize(datetime(*args))
+
+def test_a_year_of_events():
+    events = [
+        event(id="daily", time="07:30"),
+        event(id="weekdays", time="06:45", days=["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]),
+        event(id="sunday", time="23:59", days=["Sunday"]),
+        # Skipped or repeated by the clock on the days daylight saving time starts and ends
+        event(id="night", time="02:30"),
+        event(id="dark", time="17:00", onDark=True),
+    ]
+    simulation = Simulation(events, local(2026, 1, 1, 0, 0))
+    simulation.run_until(local(2027, 1, 1, 0, 0))
+
+    daily = simulation.fired_times("daily")
+    assert len(daily) == 365
+    assert all(fired.astimezone(TIMEZONE).time() == time(7, 30) for fired in daily)
+    assert len({fired.date() for fired in daily}) == 365
+
+    weekdays = simulation.fired_times("weekdays")
+    assert len(weekdays) == 261
+    assert all(fired.astimezone(TIMEZONE).weekday() < 5 for fired in weekdays)
+
+    sunday = simulation.fired_times("sunday")
+    assert len(sunday) == 52
+    assert all(fired.astimezone(TIMEZONE).weekday() == 6 for fired in sunday)
+
+    night = simulation.fired_times("night")
+    assert len(night) == 365
+    days = Counter(fired.astimezone(TIMEZONE).date() for fired in night)
+    assert max(days.values()) == 1
+    # 02:30 does not exist when the clock jumps from 02:00 to 03:00
+    spring = [fired for fired in night if fired.astimezone(TIMEZONE).date() == datetime(2026, 3, 29).date()]
+    assert spring[0].astimezone(TIMEZONE).time() == time(3, 30)
+
+    # Dark at 17:00 in winter, light in summer
+    dark_months = {fired.astimezone(TIMEZONE).month for fired in simulation.fired_times("dark")}
+    assert {1, 2, 11, 12} <= dark_months
+    assert not {5, 6, 7} & dark_months
+
+def test_events_fire_on_time():
+    events = [event(id="daily", time="07:30")]
+    simulation = Simulation(events, local(2026, 6, 1, 0, 0))
+    simulation.run_until(local(2026, 6, 8, 0, 0))
+    assert simulation.fired_times("daily") == [local(2026, 6, day, 7, 30) for day in range(1, 8)]
+
+def test_wait_for_sunrise_is_rescheduled():
+    events = [event(id="sunrise", time="06:00", waitForSunrise=True)]
+    simulation = Simulation(events, local(2026, 12, 1, 0, 0))
+    simulation.run_until(local(2026, 12, 1, 12, 0))
+    fired = simulation.fired_times("sunrise")
+    assert len(fired) == 1
+    assert local(2026, 12, 1, 8, 0) < fired[0] < local(2026, 12, 1, 9, 30)
+
+def test_deleted_event_does_not_fire_after_rescheduling():
+    events = [event(id="sunrise", time="06:00", waitForSunrise=True)]
+    simulation = Simulation(events, local(2026, 12, 1, 0, 0))
+    simulation.run_until(local(2026, 12, 1, 6, 1))
+    events.clear()
+    simulation.scheduler.reload()
+    simulation.run_until(local(2026, 12, 2, 12, 0))
+    assert simulation.fired == []
+
+def test_edited_event_does_not_fire_after_rescheduling():
+    events = [event(id="sunrise", time="06:00", waitForSunrise=True)]
+    simulation = Simulation(events, local(2026, 12, 1, 0, 0))
+    simulation.run_until(local(2026, 12, 1, 6, 1))
+    events[0] = event(id="sunrise", time="10:00")
+    simulation.scheduler.reload()
+    simulation.run_until(local(2026, 12, 1, 12, 0))
+    assert simulation.fired_times("sunrise") == [local(2026, 12, 1, 10, 0)]
+
+def test_overdue_events_are_skipped():
+    events = [event(id="daily", time="07:30")]
+    simulation = Simulation(events, local(2026, 6, 1, 7, 0))
+    simulation.scheduler.run_pending()
+    # The clock jumps past the event, for example after a suspend
+    simulation.now = local(2026, 6, 1, 9, 0)
+    simulation.run_until(local(2026, 6, 2, 8, 0))
+    assert simulation.fired_times("daily") == [local(2026, 6, 2, 7, 30)]
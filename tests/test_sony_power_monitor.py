@@ -0,0 +1,53 @@
+import threading
+import time
+from channel_handler import SonyPowerMonitor
+
+# A TV in standby does not respond, so every probe takes the full timeout
+class FakeTV:
+    def __init__(self, is_on: bool, probe_seconds: float):
+        self.is_on = is_on
+        self.probe_seconds = probe_seconds
+        self.probes = 0
+
+    def probe(self) -> bool:
+        is_on = self.is_on
+        time.sleep(self.probe_seconds)
+        self.probes += 1
+        return is_on
+
+def start_monitor(tv: FakeTV) -> SonyPowerMonitor:
+    monitor = SonyPowerMonitor(tv.probe)
+    monitor.PROBE_TIMEOUT = tv.probe_seconds
+    monitor.start()
+    while monitor.last_updated is None:
+        time.sleep(0.01)
+    return monitor
+
+def test_slow_probe_longer_than_delay_matches():
+    monitor = start_monitor(FakeTV(False, 0.3))
+    assert monitor.wait_for_state(False, 0.1)
+
+def test_zero_delay_probes_once():
+    tv = FakeTV(False, 0.1)
+    monitor = start_monitor(tv)
+    probes = tv.probes
+    assert monitor.wait_for_state(False, 0)
+    assert tv.probes > probes
+    assert not monitor.wait_for_state(True, 0)
+
+def test_stale_cached_state_does_not_match():
+    tv = FakeTV(True, 0.1)
+    monitor = start_monitor(tv)
+    tv.is_on = False
+    start = time.monotonic()
+    assert not monitor.wait_for_state(True, 0.3)
+    assert time.monotonic() - start >= 0.3
+
+def test_state_reached_during_the_delay():
+    tv = FakeTV(False, 0.05)
+    monitor = start_monitor(tv)
+    monitor.FAST_INTERVAL = 0.1
+    threading.Timer(0.2, lambda: setattr(tv, "is_on", True)).start()
+    start = time.monotonic()
+    assert monitor.wait_for_state(True, 2)
+    assert 0.2 <= time.monotonic() - start < 1
@@ -0,0 +1,99 @@
+import logging
+import time
+import pytest
+from aiocoap.error import NotObservable
+import IKEA
+from IKEA import CommandResult, TradfriHandler, TradfriObserver
+from fake_tradfri import FakeGateway, ObservableFakeGateway
+
+GROUP_ID = 131073
+
+def wait_until(condition, timeout: float = 2) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+observers = []
+
+@pytest.fixture(autouse=True)
+def stop_observers():
+    yield
+    while observers:
+        observers.pop().stop()
+
+def observe(gateway: FakeGateway, **kwargs) -> tuple[TradfriHandler, ObservableFakeGateway]:
+    handler = TradfriHandler("gateway", "key", logging.getLogger(__name__), api=gateway)
+    observable = ObservableFakeGateway(gateway)
+    handler.observer = TradfriObserver(handler, handler.logger, api=observable.request, **kwargs)
+    observers.append(handler.observer)
+    handler.observer.sync()
+    assert wait_until(lambda: all(map(handler.observer.is_observing, handler.groups)))
+    return handler, observable
+
+def test_observes_every_group_and_light():
+    gateway = FakeGateway(groups=3, lights=2)
+    handler, observable = observe(gateway)
+    assert len(observable.observations) == 3 + 3 * 2
+    assert handler.get_age(GROUP_ID) == 0
+
+def test_changes_with_the_remote_are_applied():
+    gateway = FakeGateway()
+    handler, _ = observe(gateway)
+    requests = gateway.requests
+    device_id = gateway.members(GROUP_ID)[0]
+    gateway.set_light(device_id, "5851", 30)
+    assert wait_until(lambda: handler.get_dimmer(GROUP_ID, None) == 30)
+    assert handler.get_export_snapshot()[GROUP_ID]["dimmer"] == 30
+    # Nothing was fetched from the gateway
+    assert gateway.requests == requests
+
+def test_restarts_after_the_gateway_ended_the_observation(caplog):
+    gateway = FakeGateway(groups=1, lights=1)
+    handler, observable = observe(gateway, retry_delay=0.1)
+    with caplog.at_level(logging.INFO):
+        observable.end("15004/{}".format(GROUP_ID), NotObservable())
+        assert wait_until(lambda: not handler.observer.is_observing(GROUP_ID))
+        assert wait_until(lambda: handler.observer.is_observing(GROUP_ID))
+    assert observable.observes == 3
+    # Ending normally is not an error
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+
+def test_backs_off_while_the_gateway_is_unreachable():
+    gateway = FakeGateway(groups=1, lights=1)
+    handler, observable = observe(gateway, retry_delay=0.05, max_retry_delay=0.2)
+    attempts = []
+    original = observable.request
+
+    async def request(command, timeout=None):
+        if command.path_str == "15004/{}".format(GROUP_ID) and not command.observe:
+            attempts.append(time.monotonic())
+        return await original(command, timeout)
+
+    handler.observer.api = request
+    gateway.offline = True
+    observable.end("15004/{}".format(GROUP_ID), ConnectionResetError("Connection lost"))
+    assert wait_until(lambda: len(attempts) >= 5, timeout=3)
+    gateway.offline = False
+    assert wait_until(lambda: handler.observer.is_observing(GROUP_ID), timeout=3)
+
+    delays = [later - earlier for earlier, later in zip(attempts, attempts[1:])][:4]
+    # 0.05 s doubling up to 0.2 s
+    assert delays[1] > delays[0] * 1.5
+    assert all(delay < 0.35 for delay in delays)
+
+def test_commands_converge_on_the_state_reported_by_the_gateway(monkeypatch):
+    monkeypatch.setattr(IKEA, "RECONCILE_INITIAL_DELAY_SECONDS", 0.001)
+    monkeypatch.setattr(IKEA, "RECONCILE_MAX_ATTEMPTS", 3)
+    gateway = FakeGateway(converge_after=None)
+    handler, _ = observe(gateway)
+    # The group takes the value, but its lights never follow
+    assert handler.set_state(GROUP_ID, False) == CommandResult.NOT_CONVERGED
+
+def test_commands_converge_while_observed():
+    gateway = FakeGateway()
+    handler, _ = observe(gateway)
+    assert handler.set_dimmer(GROUP_ID, 20) == CommandResult.OK
+    assert wait_until(lambda: handler.get_export_snapshot()[GROUP_ID]["dimmer"] == 20)
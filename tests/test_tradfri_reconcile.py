@@ -0,0 +1,97 @@
+import logging
+import time
+import pytest
+import IKEA
+from IKEA import CommandResult, TradfriHandler
+from fake_tradfri import FakeGateway
+
+GROUP_ID = 131073
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(IKEA, "RECONCILE_INITIAL_DELAY_SECONDS", 0.001)
+
+def create_handler(gateway: FakeGateway) -> TradfriHandler:
+    return TradfriHandler("gateway", "key", logging.getLogger(__name__), api=gateway)
+
+def light_values(gateway: FakeGateway, key: str) -> list:
+    return [gateway.light(device_id)[key] for device_id in gateway.members(GROUP_ID)]
+
+def test_converges_on_the_first_attempt():
+    gateway = FakeGateway()
+    handler = create_handler(gateway)
+    assert handler.set_state(GROUP_ID, False) == CommandResult.OK
+    assert light_values(gateway, "5850") == [0, 0, 0]
+    assert handler.export_command_stats()["state"]["attempts"] == {1: 1}
+
+@pytest.mark.parametrize("attempts", [2, 3, 5])
+def test_converges_after_some_attempts(attempts):
+    gateway = FakeGateway(converge_after=attempts)
+    handler = create_handler(gateway)
+    assert handler.set_state(GROUP_ID, False) == CommandResult.OK
+    assert gateway.puts[GROUP_ID] == attempts
+    assert handler.export_command_stats()["state"]["attempts"] == {attempts: 1}
+
+def test_gives_up_after_the_maximum_attempts(monkeypatch):
+    monkeypatch.setattr(IKEA, "RECONCILE_MAX_ATTEMPTS", 4)
+    gateway = FakeGateway(converge_after=None)
+    handler = create_handler(gateway)
+    assert handler.set_dimmer(GROUP_ID, 50) == CommandResult.NOT_CONVERGED
+    assert gateway.puts[GROUP_ID] == 4
+    assert handler.export_command_stats()["dimmer"]["results"] == {"not-converged": 1}
+
+def test_gives_up_at_the_deadline(monkeypatch):
+    monkeypatch.setattr(IKEA, "RECONCILE_INITIAL_DELAY_SECONDS", 0.05)
+    monkeypatch.setattr(IKEA, "RECONCILE_DEADLINE_SECONDS", 0.2)
+    handler = create_handler(FakeGateway(converge_after=None))
+    start = time.monotonic()
+    assert handler.set_state(GROUP_ID, False) == CommandResult.NOT_CONVERGED
+    assert time.monotonic() - start < 0.5
+
+def test_unknown_group():
+    handler = create_handler(FakeGateway())
+    assert handler.set_state(1, True) == CommandResult.NOT_FOUND
+
+def test_gateway_timeout():
+    gateway = FakeGateway()
+    handler = create_handler(gateway)
+    gateway.offline = True
+    assert handler.set_state(GROUP_ID, False) == CommandResult.FAILED
+
+def test_dimmer_the_group_already_has():
+    # The group believes it is at 100 while the remote dimmed the lights
+    gateway = FakeGateway(ignore_unchanged_dimmer=True)
+    for device_id in gateway.members(GROUP_ID):
+        gateway.set_light(device_id, "5851", 50)
+    handler = create_handler(gateway)
+    assert handler.set_dimmer(GROUP_ID, 100) == CommandResult.OK
+    assert light_values(gateway, "5851") == [100, 100, 100]
+
+def test_batch_dimmer_the_group_already_has():
+    gateway = FakeGateway(ignore_unchanged_dimmer=True)
+    for device_id in gateway.members(GROUP_ID):
+        gateway.set_light(device_id, "5851", 50)
+    handler = create_handler(gateway)
+    results = handler.apply_batch({str(GROUP_ID): {"dimmer": 100, "light-state": True}})
+    assert results[GROUP_ID]["result"] == "ok"
+    assert light_values(gateway, "5851") == [100, 100, 100]
+
+def test_batch_reports_every_group():
+    gateway = FakeGateway(groups=3, converge_after=None)
+    handler = create_handler(gateway)
+    results = handler.apply_batch({"131073": {"light-state": False}, "131074": {"color": "#ff0000"},
+                                   "99": {"dimmer": 10}})
+    assert results[131073]["result"] == "not-converged"
+    # Only the state and dimmer are checked for convergence
+    assert results[131074]["result"] == "ok"
+    assert results[99]["result"] == "not-found"
+
+def test_stats_include_the_last_refresh():
+    gateway = FakeGateway(groups=3, latency=0.01)
+    handler = create_handler(gateway)
+    handler.set_state(GROUP_ID, False)
+    stats = handler.export_stats()
+    assert stats["commands"]["state"]["results"] == {"ok": 1}
+    assert stats["refresh"]["groups"] == 3
+    timings = stats["refresh"]["timings"]
+    assert timings["total"] >= timings["groups"] > 0
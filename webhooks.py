@@ -0,0 +1,304 @@
+import operator
+from datetime import datetime, time
+from logging import Logger
+from concurrent.futures import Future
+from threading import Lock, Timer
+import threading
+from time import monotonic
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
+import pytz
+import util
+
+# Predicates are evaluated cheapest first, so that a part that does not match
+# at this time of the day never causes any requests to the devices
+COST_LOCAL = 0
+COST_CACHED = 1
+COST_REMOTE = 2
+COST_WAIT = 3
+
+OPERATORS = {
+    '=' : operator.eq,
+    '!=' : operator.ne,
+    '>=' : operator.ge,
+    '<=' : operator.le,
+    '>' : operator.gt,
+    '<' : operator.lt,
+}
+
+# The state read while one webhook is invoked, shared by all its parts
+class Invocation:
+    def __init__(self, tradfri_handler, power_monitor, timezone: pytz.timezone):
+        self.tradfri_handler = tradfri_handler
+        self.power_monitor = power_monitor
+        self.now = datetime.now(timezone)
+        # Group ID -> the max age the cached group was last made to satisfy
+        self.group_max_ages: Dict[int, float] = {}
+        # (required state, delay) -> whether the TV reached the state in time
+        self.sony_waits: Dict[Tuple[bool, float], bool] = {}
+
+    # Every group is fetched at most once, unless a later condition needs a fresher state
+    def get_max_age(self, group_id: int, max_age: Optional[float]) -> Optional[float]:
+        satisfied = self.group_max_ages.get(group_id)
+        if max_age is None or (satisfied is not None and satisfied <= max_age):
+            return None
+        self.group_max_ages[group_id] = max_age
+        return max_age
+
+    def get_tradfri_state(self, group_id: int, max_age: Optional[float]) -> bool:
+        return self.tradfri_handler.get_state(group_id, self.get_max_age(group_id, max_age))
+
+    def get_tradfri_dimmer(self, group_id: int, max_age: Optional[float]) -> int:
+        return self.tradfri_handler.get_dimmer(group_id, self.get_max_age(group_id, max_age))
+
+    def wait_for_sony_state(self, required: bool, delay: float) -> bool:
+        if (required, delay) not in self.sony_waits:
+            self.sony_waits[(required, delay)] = self.power_monitor.wait_for_state(required, delay)
+        return self.sony_waits[(required, delay)]
+
+class Predicate(NamedTuple):
+    name: str
+    cost: int
+    test: Callable[[Invocation], bool]
+
+class WebhookPart(NamedTuple):
+    predicates: List[Predicate]
+    actions: dict
+
+    # Evaluates the predicates until one of them fails. Adds the name, result
+    # and evaluation time of every evaluated predicate to the timings.
+    def matches(self, invocation: Invocation, timings: List[dict]) -> bool:
+        for predicate in self.predicates:
+            start = monotonic()
+            result = predicate.test(invocation)
+            timings.append({"name": predicate.name, "result": result, "seconds": monotonic() - start})
+            if not result:
+                return False
+        return True
+
+def parse_operator_value(input: str) -> Tuple[Callable, int]:
+    head = input.rstrip('0123456789')
+    tail = input[len(head):]
+    if head not in OPERATORS or not tail:
+        raise ValueError("Invalid condition: {}".format(input))
+    return OPERATORS[head], int(tail)
+
+def compile_part(part: dict) -> WebhookPart:
+    if "actions" not in part:
+        raise ValueError("A webhook part needs actions.")
+    conditional = part.get("conditional", {})
+    predicates = []
+
+    if "within-time" in conditional:
+        within_time = conditional["within-time"]
+        start = time(*util.get_hour_minute(within_time["start"]))
+        end = time(*util.get_hour_minute(within_time["end"]))
+        predicates.append(Predicate("within-time", COST_LOCAL,
+                                    lambda invocation: util.time_in_range(start, end, invocation.now.time())))
+
+    if "within-months" in conditional:
+        start_month = conditional["within-months"]["start"]
+        end_month = conditional["within-months"]["end"]
+        def within_months(invocation: Invocation) -> bool:
+            current_month = invocation.now.month
+            if start_month > end_month: # for example start: 8, end: 4
+                return current_month >= start_month or current_month <= end_month
+            return start_month <= current_month <= end_month # for example start: 1, end: 4
+        predicates.append(Predicate("within-months", COST_LOCAL, within_months))
+
+    for device, conditions in conditional.get("tradfri", {}).items():
+        predicates += compile_tradfri_conditions(int(device), conditions)
+
+    if "sony-bravia-tv" in conditional and "is-on" in conditional["sony-bravia-tv"]:
+        required = conditional["sony-bravia-tv"]["is-on"]
+        if "delay" in conditional["sony-bravia-tv"]:
+            # Since the TV takes some time to update its API, wait at most
+            # this long for it to reach the required state
+            delay = conditional["sony-bravia-tv"]["delay"] / 1000
+            predicates.append(Predicate("sony-bravia-tv is-on", COST_WAIT,
+                                        lambda invocation: invocation.wait_for_sony_state(required, delay)))
+        else:
+            predicates.append(Predicate("sony-bravia-tv is-on", COST_CACHED,
+                                        lambda invocation: invocation.power_monitor.is_on == required))
+
+    # sorted keeps the order of the configuration for predicates of the same cost
+    return WebhookPart(sorted(predicates, key=lambda predicate: predicate.cost), part["actions"])
+
+def compile_tradfri_conditions(group_id: int, conditions: dict) -> List[Predicate]:
+    predicates = []
+    # Maximum allowed age in seconds of the cached state, refetch by default
+    max_age = conditions.get("max-age", 0)
+    cost = COST_REMOTE if max_age == 0 else COST_CACHED
+
+    if "light-state" in conditions:
+        light_state = conditions["light-state"]
+        predicates.append(Predicate("tradfri {} light-state".format(group_id), cost,
+                                    lambda invocation: invocation.get_tradfri_state(group_id, max_age) == light_state))
+
+    if "dimmer" in conditions:
+        op, value = parse_operator_value(conditions["dimmer"])
+        predicates.append(Predicate("tradfri {} dimmer {}".format(group_id, conditions["dimmer"]), cost,
+                                    lambda invocation: op(invocation.get_tradfri_dimmer(group_id, max_age), value)))
+    return predicates
+
+class Limit(NamedTuple):
+    # "throttle" runs at most once per interval, "debounce" once the calls
+    # have stopped for the interval
+    mode: str
+    interval: float
+    # Run on the first call, and after the interval if there were more calls
+    leading: bool
+    trailing: bool
+
+class Webhook(NamedTuple):
+    id: str
+    parts: List[WebhookPart]
+    limit: Optional[Limit]
+
+# A webhook is a list of parts, or {"parts": [...], "throttle": 5} to run at most once
+# every five seconds, or {"parts": [...], "debounce": 2} to run once two seconds after
+# the last call. "leading" and "trailing" change whether the first call runs right
+# away and whether a later call runs at the end of the interval.
+def compile_webhook(webhook_id: str, configuration: Union[list, dict]) -> Webhook:
+    if isinstance(configuration, list):
+        return Webhook(webhook_id, [compile_part(part) for part in configuration], None)
+
+    parts = [compile_part(part) for part in configuration["parts"]]
+    limit = None
+    for mode, leading, trailing in [("throttle", True, False), ("debounce", False, True)]:
+        if mode in configuration:
+            interval = float(configuration[mode])
+            if interval <= 0:
+                raise ValueError("The {} interval must be positive.".format(mode))
+            limit = Limit(mode, interval, bool(configuration.get("leading", leading)),
+                          bool(configuration.get("trailing", trailing)))
+    return Webhook(webhook_id, parts, limit)
+
+class WebhookRegistry:
+    def __init__(self, logger: Logger):
+        self.logger = logger
+        self.lock = Lock()
+        self.webhooks: Dict[str, Webhook] = {}
+
+    def load(self, activities: dict):
+        webhooks = {}
+        for webhook_id, configuration in activities.get("webhooks", {}).items():
+            try:
+                webhooks[webhook_id] = compile_webhook(webhook_id, configuration)
+            except (KeyError, TypeError, ValueError) as error:
+                self.logger.error("Invalid webhook {}: {}".format(webhook_id, error))
+        with self.lock:
+            self.webhooks = webhooks
+
+    def get(self, webhook_id: str) -> Optional[Webhook]:
+        return self.webhooks.get(webhook_id)
+
+# Decides whether a call of a webhook starts it, joins the execution that is
+# already running, is deferred to the end of the interval or is suppressed
+class WebhookGate:
+    STARTED = "started"
+    JOINED = "joined"
+    DEFERRED = "deferred"
+    SUPPRESSED = "suppressed"
+
+    def __init__(self, logger: Logger, start: Callable[[Webhook], Tuple[str, Future]],
+                 now: Callable[[], float] = monotonic):
+        self.logger = logger
+        self.start = start
+        self.now = now
+        self.lock = Lock()
+        # Webhook ID -> (job ID, future) of the execution that is running
+        self.running: Dict[str, Tuple[str, Future]] = {}
+        # Webhook ID -> when the current interval ends
+        self.window_ends: Dict[str, float] = {}
+        self.timers: Dict[str, Timer] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+
+    # Returns the outcome of the call and, unless it was deferred or suppressed,
+    # the job ID and future of the execution
+    def invoke(self, webhook: Webhook) -> Tuple[str, Optional[str], Optional[Future]]:
+        with self.lock:
+            outcome, job_id, future = self.invoke_locked(webhook)
+        if outcome == self.STARTED:
+            self.watch(webhook.id, future)
+        return outcome, job_id, future
+
+    def invoke_locked(self, webhook: Webhook) -> Tuple[str, Optional[str], Optional[Future]]:
+        if webhook.id in self.running:
+            return self.count(webhook, self.JOINED, *self.running[webhook.id])
+
+        limit = webhook.limit
+        if limit is None:
+            return self.count(webhook, self.STARTED, *self.start_locked(webhook))
+
+        now = self.now()
+        if now >= self.window_ends.get(webhook.id, 0):
+            # First call since the last interval ended
+            self.window_ends[webhook.id] = now + limit.interval
+            if limit.leading:
+                return self.count(webhook, self.STARTED, *self.start_locked(webhook))
+            self.schedule(webhook)
+            return self.count(webhook, self.DEFERRED)
+
+        if limit.mode == "debounce":
+            # Every call restarts the interval
+            self.window_ends[webhook.id] = now + limit.interval
+        if limit.trailing:
+            self.schedule(webhook)
+            return self.count(webhook, self.DEFERRED)
+        return self.count(webhook, self.SUPPRESSED)
+
+    # The caller has to watch the future once it has released the lock
+    def start_locked(self, webhook: Webhook) -> Tuple[str, Future]:
+        job_id, future = self.start(webhook)
+        self.running[webhook.id] = (job_id, future)
+        return job_id, future
+
+    # A future that is already done runs the callback right away on this
+    # thread, so this must not be called while holding the lock
+    def watch(self, webhook_id: str, future: Future):
+        future.add_done_callback(lambda _: self.finished(webhook_id, future))
+
+    def finished(self, webhook_id: str, future: Future):
+        with self.lock:
+            if webhook_id in self.running and self.running[webhook_id][1] is future:
+                del self.running[webhook_id]
+
+    # Runs the webhook when the interval ends, unless it is already going to
+    def schedule(self, webhook: Webhook):
+        timer = self.timers.get(webhook.id)
+        if timer is not None:
+            if webhook.limit.mode == "throttle":
+                return
+            timer.cancel()
+        timer = Timer(self.window_ends[webhook.id] - self.now(), self.run_trailing, [webhook])
+        timer.daemon = True
+        self.timers[webhook.id] = timer
+        timer.start()
+
+    def run_trailing(self, webhook: Webhook):
+        with self.lock:
+            if self.timers.get(webhook.id) is not threading.current_thread():
+                # Replaced by a later call
+                return
+            del self.timers[webhook.id]
+            if webhook.id in self.running:
+                self.count(webhook, self.JOINED)
+                return
+            # The trailing execution starts a new interval
+            self.window_ends[webhook.id] = self.now() + webhook.limit.interval
+            try:
+                _, future = self.start_locked(webhook)
+            except Exception as error:
+                self.logger.error("Unable to run webhook {}: {}".format(webhook.id, error))
+                return
+        self.watch(webhook.id, future)
+
+    def count(self, webhook: Webhook, outcome: str, job_id: str = None, future: Future = None):
+        counters = self.counters.setdefault(webhook.id, dict.fromkeys(
+            [self.STARTED, self.JOINED, self.DEFERRED, self.SUPPRESSED], 0))
+        counters[outcome] += 1
+        return outcome, job_id, future
+
+    def export_stats(self) -> dict:
+        with self.lock:
+            return {webhook_id: dict(counters) for webhook_id, counters in self.counters.items()}